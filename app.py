@@ -1,29 +1,197 @@
+import csv
+import hashlib
+import io
+import json
+import math
 import os
-from datetime import datetime, date
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 from calendar import month_name
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from functools import wraps
 
-from flask import Flask, render_template, request, redirect, url_for, flash
+import click
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify,
+                   Response, g, has_app_context, has_request_context, send_file, stream_with_context,
+                   before_render_template, template_rendered, session, get_flashed_messages)
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from werkzeug.http import is_resource_modified
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, case, tuple_, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy.sql import Select
 
 # --- App and DB Configuration ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a_very_secret_key_that_should_be_changed')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['DATABASE_REPLICA_URL'] = os.environ.get('DATABASE_REPLICA_URL')  # optional read replica
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '1') == '1'
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 0))  # 0 disables the slow-query log
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_REDIS_URL'] = os.environ.get('USER_CACHE_REDIS_URL')  # optional, shared by all workers
+app.config['REPORT_JOB_THREADS'] = int(os.environ.get('REPORT_JOB_THREADS', 2))  # 0 when `flask worker` runs jobs
+app.config['REPORT_JOB_CACHE_TTL'] = int(os.environ.get('REPORT_JOB_CACHE_TTL', 300))
+app.config['REPORT_JOB_MAX_BYTES'] = int(os.environ.get('REPORT_JOB_MAX_BYTES', 20 * 1024 * 1024))
+app.config['HTTP_CACHING'] = os.environ.get('HTTP_CACHING', '1') == '1'
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 256))
+app.config['PAYMENT_ARCHIVE_MONTHS'] = int(os.environ.get('PAYMENT_ARCHIVE_MONTHS', 24))  # keep this many full months hot
+
+
+# --- Database Engine Profile ---
+# Pool sizing, pre-ping, recycle and a statement timeout for server databases;
+# WAL and related pragmas for SQLite so one worker's write doesn't block readers.
+def engine_options(url):
+    if url.startswith('sqlite'):
+        return {}
+    options = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+    statement_timeout_ms = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))
+    if url.startswith('postgres') and statement_timeout_ms:
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout_ms}'}
+    return options
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+if app.config['DATABASE_REPLICA_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['DATABASE_REPLICA_URL']}
+
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+}
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+class RoutingSession(FlaskSQLAlchemySession):
+    """Sends SELECTs issued by @read_replica views to the 'replica' bind when one is configured."""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and isinstance(clause, Select) and not self._flushing
+                and has_request_context() and g.get('use_replica') and 'replica' in self._db.engines):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+@app.before_request
+def _reset_replica_routing():
+    g.pop('use_replica', None)
+
+def read_replica(f):
+    """Mark a read-only view whose queries may be served by the read replica.
+
+    Apply it above @conditional_view, so the ETag and fragment versions are read
+    from the same (possibly lagging) database the page is rendered from.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.use_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
 
 # --- Initialize Extensions ---
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login' 
 login_manager.login_message_category = 'danger' 
 
+# --- User Identity Cache ---
+# The logged-in user's identity is cached as a plain snapshot, so a cache hit
+# costs no database query. Entries expire after USER_CACHE_TTL seconds and are
+# dropped when an admin changes or deletes the user. With USER_CACHE_REDIS_URL
+# set (needs the redis package) snapshots are shared by all gunicorn workers and
+# invalidations reach every worker; each worker's own copy then lives at most
+# USER_CACHE_LOCAL_TTL seconds.
+USER_CACHE_LOCAL_TTL = 5
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+_user_cache_redis = []
+
+class CachedUser(UserMixin):
+    """Read-only stand-in for the User row behind current_user."""
+    def __init__(self, id, username, is_admin):
+        self.id = id
+        self.username = username
+        self.is_admin = is_admin
+
+def _shared_user_cache():
+    url = app.config['USER_CACHE_REDIS_URL']
+    if not url:
+        return None
+    if not _user_cache_redis:
+        import redis
+        _user_cache_redis.append(redis.Redis.from_url(url))
+    return _user_cache_redis[0]
+
+def _user_cache_key(user_id):
+    return f'cablepro:user:{user_id}'
+
+def get_cached_user(user_id):
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry and entry[0] > now:
+            _user_cache.move_to_end(user_id)
+            return CachedUser(**entry[1])
+    shared = _shared_user_cache()
+    snapshot = None
+    if shared is not None:
+        cached = shared.get(_user_cache_key(user_id))
+        snapshot = json.loads(cached) if cached else None
+    if snapshot is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = {'id': user.id, 'username': user.username, 'is_admin': user.is_admin}
+        if shared is not None:
+            shared.set(_user_cache_key(user_id), json.dumps(snapshot), ex=app.config['USER_CACHE_TTL'])
+    ttl = min(app.config['USER_CACHE_TTL'], USER_CACHE_LOCAL_TTL) if shared is not None else app.config['USER_CACHE_TTL']
+    with _user_cache_lock:
+        _user_cache[user_id] = (now + ttl, snapshot)
+        _user_cache.move_to_end(user_id)
+        while len(_user_cache) > app.config['USER_CACHE_SIZE']:
+            _user_cache.popitem(last=False)
+    return CachedUser(**snapshot)
+
+def invalidate_cached_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+    shared = _shared_user_cache()
+    if shared is not None:
+        shared.delete(_user_cache_key(user_id))
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return get_cached_user(int(user_id))
 
 # --- Database Models ---
 
@@ -42,6 +210,11 @@ class User(db.Model, UserMixin):
         return check_password_hash(self.password_hash, password)
 
 class Customer(db.Model):
+    __table_args__ = (
+        db.Index('ix_customer_operator_status_name', 'operator_id', 'status', 'name'),
+        db.Index('ix_customer_status_name', 'status', 'name'),
+        db.Index('ix_customer_name', 'name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     operator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
@@ -54,8 +227,17 @@ class Customer(db.Model):
     status = db.Column(db.String(20), nullable=False, default='Active')
     notes = db.Column(db.Text)
     payments = db.relationship('Payment', backref='customer', lazy=True, cascade="all, delete-orphan")
+    invoices = db.relationship('Invoice', backref='customer', lazy=True, cascade="all, delete-orphan")
+    archived_payments = db.relationship('PaymentArchive', backref='customer', lazy=True, cascade="all, delete-orphan")
 
 class Payment(db.Model):
+    __table_args__ = (
+        db.Index('ix_payment_customer_period', 'customer_id', 'billing_period_year', 'billing_period_month'),
+        db.Index('ix_payment_period', 'billing_period_year', 'billing_period_month'),
+        db.Index('ix_payment_date_method', 'payment_date', 'payment_method'),
+        db.Index('ix_payment_date_id', 'payment_date', 'id'),
+        {'sqlite_autoincrement': True},  # archived ids must never be handed out again
+    )
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True) 
@@ -71,6 +253,83 @@ class Payment(db.Model):
     def billing_period_display(self):
         return f"{month_name[self.billing_period_month]} {self.billing_period_year}"
 
+class PaymentArchive(db.Model):
+    """Payments moved out of the live table by `flask archive-payments`; same columns and ids."""
+    __table_args__ = (
+        db.Index('ix_payment_archive_customer_period', 'customer_id', 'billing_period_year', 'billing_period_month'),
+        db.Index('ix_payment_archive_period', 'billing_period_year', 'billing_period_month'),
+        db.Index('ix_payment_archive_date_id', 'payment_date', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    payment_date = db.Column(db.Date, nullable=False)
+    amount_paid = db.Column(db.Float, nullable=False)
+    billing_period_month = db.Column(db.Integer, nullable=False)
+    billing_period_year = db.Column(db.Integer, nullable=False)
+    payment_method = db.Column(db.String(20), nullable=False, default='Cash')
+    transaction_reference = db.Column(db.String(100))
+    received_by = db.Column(db.String(100))
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    user = db.relationship('User')
+
+    @property
+    def billing_period_display(self):
+        return f"{month_name[self.billing_period_month]} {self.billing_period_year}"
+
+class Invoice(db.Model):
+    """What a customer owes for one billing period, created by a billing run."""
+    __table_args__ = (
+        db.UniqueConstraint('customer_id', 'billing_period_year', 'billing_period_month', name='uq_invoice_customer_period'),
+        db.Index('ix_invoice_period_status', 'billing_period_year', 'billing_period_month', 'status'),
+        db.Index('ix_invoice_customer_status', 'customer_id', 'status'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    billing_period_month = db.Column(db.Integer, nullable=False)
+    billing_period_year = db.Column(db.Integer, nullable=False)
+    amount_due = db.Column(db.Float, nullable=False)
+    amount_paid = db.Column(db.Float, nullable=False, default=0.0)
+    status = db.Column(db.String(10), nullable=False, default='open')  # open/partial/paid
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    @property
+    def balance(self):
+        return self.amount_due - self.amount_paid
+
+class ReportJob(db.Model):
+    """A report computed outside the request thread; `result` holds the finished CSV."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    params = db.Column(db.Text, nullable=False)  # JSON
+    params_key = db.Column(db.String(255), nullable=False, index=True)
+    status = db.Column(db.String(10), nullable=False, default='queued', index=True)  # queued/running/done/failed
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+class CollectionRollup(db.Model):
+    """Collections per day and per month, by payment method and customer operator."""
+    __table_args__ = (
+        db.UniqueConstraint('period', 'period_start', 'payment_method', 'operator_id', name='uq_collection_rollup_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(5), nullable=False)  # 'day' or 'month'
+    period_start = db.Column(db.Date, nullable=False)
+    payment_method = db.Column(db.String(20), nullable=False)
+    operator_id = db.Column(db.Integer, nullable=False)  # denormalized; no FK so users stay deletable
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    payment_count = db.Column(db.Integer, nullable=False, default=0)
+
+class DataVersion(db.Model):
+    """Change counter per operator (scope 0 covers everyone), bumped by customer/payment writes."""
+    scope = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
 # --- Utility Functions & Decorators ---
 def get_billing_periods():
     current_year = datetime.now().year
@@ -87,12 +346,1181 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Query Counting ---
+# Counts the SQL statements issued on the current thread so views can be held
+# to a query budget (see the check-query-budgets command).
+_query_counters = threading.local()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_query_counters, 'active', ()):
+        counter['count'] += 1
+        counter['statements'].append(statement)
+
+@contextmanager
+def count_queries():
+    """Yield a dict whose 'count' and 'statements' track the SQL run inside the block."""
+    counter = {'count': 0, 'statements': []}
+    active = _query_counters.__dict__.setdefault('active', [])
+    active.append(counter)
+    try:
+        yield counter
+    finally:
+        active.remove(counter)
+
+@contextmanager
+def query_budget(max_queries, label='block'):
+    """Fail with AssertionError if the block issues more than `max_queries` statements."""
+    with count_queries() as counter:
+        yield counter
+    if counter['count'] > max_queries:
+        raise AssertionError(
+            f"{label} issued {counter['count']} queries (budget {max_queries}):\n" + '\n'.join(counter['statements'])
+        )
+
+# --- Request Profiling ---
+# Each request records its SQL count/time, template render time and any
+# timed_phase() blocks. These go out as a Server-Timing header and are
+# aggregated per endpoint for /metrics (per worker process).
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_route_metrics = {}
+_route_metrics_lock = threading.Lock()
+
+def _current_profile():
+    return g.get('profile') if has_app_context() else None
+
+@app.before_request
+def _start_request_profile():
+    g.profile = {'started': time.perf_counter(), 'sql_count': 0, 'sql_time': 0.0, 'render_time': 0.0, 'phases': {}}
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    profile = _current_profile()
+    if profile is not None:
+        profile['sql_count'] += 1
+        profile['sql_time'] += elapsed
+    slow_query_ms = app.config['SLOW_QUERY_MS']
+    if slow_query_ms and elapsed * 1000 >= slow_query_ms:
+        route = request.endpoint if has_request_context() else 'cli'
+        app.logger.warning("Slow query (%.1f ms) in %s: %s %r", elapsed * 1000, route, statement, parameters)
+
+@event.listens_for(Engine, 'handle_error')
+def _discard_query_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+@before_render_template.connect_via(app)
+def _start_render_timer(sender, template, context, **extra):
+    profile = _current_profile()
+    if profile is not None:
+        profile['render_started'] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _record_render_time(sender, template, context, **extra):
+    profile = _current_profile()
+    if profile is not None and 'render_started' in profile:
+        profile['render_time'] += time.perf_counter() - profile.pop('render_started')
+
+@contextmanager
+def timed_phase(name):
+    """Time a block of request work and report it as its own Server-Timing entry."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile = _current_profile()
+        if profile is not None:
+            profile['phases'][name] = profile['phases'].get(name, 0.0) + time.perf_counter() - started
+
+@app.after_request
+def _finish_request_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    total = time.perf_counter() - profile['started']
+    with _route_metrics_lock:
+        metrics = _route_metrics.setdefault(request.endpoint or 'unmatched', {
+            'count': 0, 'duration': 0.0, 'sql_count': 0, 'sql_time': 0.0, 'render_time': 0.0,
+            'buckets': [0] * len(REQUEST_DURATION_BUCKETS),
+        })
+        metrics['count'] += 1
+        metrics['duration'] += total
+        metrics['sql_count'] += profile['sql_count']
+        metrics['sql_time'] += profile['sql_time']
+        metrics['render_time'] += profile['render_time']
+        for i, bound in enumerate(REQUEST_DURATION_BUCKETS):
+            if total <= bound:
+                metrics['buckets'][i] += 1
+    if app.config['SERVER_TIMING']:
+        timings = [f'db;dur={profile["sql_time"] * 1000:.1f};desc="{profile["sql_count"]} queries"',
+                   f'render;dur={profile["render_time"] * 1000:.1f}']
+        timings += [f'{name};dur={elapsed * 1000:.1f}' for name, elapsed in profile['phases'].items()]
+        timings.append(f'total;dur={total * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+def prometheus_metrics():
+    """Render the per-endpoint request metrics in Prometheus text exposition format."""
+    lines = []
+    def family(name, kind, help_text):
+        lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {kind}'])
+    with _route_metrics_lock:
+        snapshot = {endpoint: dict(m, buckets=list(m['buckets'])) for endpoint, m in sorted(_route_metrics.items())}
+    family('cablepro_request_duration_seconds', 'histogram', 'Request handling time by endpoint.')
+    for endpoint, m in snapshot.items():
+        for bound, count in zip(REQUEST_DURATION_BUCKETS, m['buckets']):
+            lines.append(f'cablepro_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+        lines.append(f'cablepro_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {m["count"]}')
+        lines.append(f'cablepro_request_duration_seconds_sum{{endpoint="{endpoint}"}} {m["duration"]:.6f}')
+        lines.append(f'cablepro_request_duration_seconds_count{{endpoint="{endpoint}"}} {m["count"]}')
+    for name, key, help_text in (
+        ('cablepro_sql_queries_total', 'sql_count', 'SQL statements executed by endpoint.'),
+        ('cablepro_sql_duration_seconds_total', 'sql_time', 'Time spent in SQL statements by endpoint.'),
+        ('cablepro_render_duration_seconds_total', 'render_time', 'Time spent rendering templates by endpoint.'),
+    ):
+        family(name, 'counter', help_text)
+        for endpoint, m in snapshot.items():
+            lines.append(f'{name}{{endpoint="{endpoint}"}} {round(m[key], 6)}')
+    return '\n'.join(lines) + '\n'
+
+# --- Dashboard Statistics ---
+# KPI tiles are cached per operator for a few seconds so repeated dashboard
+# loads don't hit the database. The key includes the operator's data version,
+# so a write from any worker or CLI command makes the next load miss.
+DASHBOARD_CACHE_TTL = int(os.environ.get('DASHBOARD_CACHE_TTL', 30))
+_dashboard_cache = {}
+
+def paid_for_period(month, year):
+    """Correlated EXISTS: has the outer Customer paid for the given billing period?"""
+    paid = [db.session.query(model.id).filter(
+        model.customer_id == Customer.id,
+        model.billing_period_month == month,
+        model.billing_period_year == year
+    ).exists() for model in payment_models(period_archived(month, year))]
+    return or_(*paid) if len(paid) > 1 else paid[0]
+
+def get_dashboard_stats(operator_id, month, year):
+    """Return the dashboard KPI tiles, scoped to an operator (None = all customers)."""
+    today = date.today()
+    cache_key = (operator_id, month, year, today, data_version(0 if operator_id is None else operator_id)[0])
+    now = datetime.now().timestamp()
+    cached = _dashboard_cache.get(cache_key)
+    if cached and cached[0] > now:
+        return cached[1]
+    for key in [key for key, (expires, _) in _dashboard_cache.items() if expires <= now]:
+        _dashboard_cache.pop(key, None)
+    is_active = Customer.status == 'Active'
+    counts = db.session.query(
+        db.func.count(Customer.id),
+        db.func.coalesce(db.func.sum(case((is_active, 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(case((owes_for_period(month, year), 1), else_=0)), 0)
+    )
+    collections = db.session.query(db.func.coalesce(db.func.sum(Payment.amount_paid), 0.0)).filter(
+        Payment.payment_date == today
+    )
+    if operator_id is not None:
+        counts = counts.filter(Customer.operator_id == operator_id)
+        collections = collections.join(Customer).filter(Customer.operator_id == operator_id)
+    total, active, outstanding = counts.one()
+    stats = {
+        'total_customers_count': total,
+        'active_customers_count': active,
+        'outstanding_payments_count': outstanding,
+        'collections_today': collections.scalar(),
+    }
+    _dashboard_cache[cache_key] = (now + DASHBOARD_CACHE_TTL, stats)
+    return stats
+
+def invalidate_dashboard_cache():
+    _dashboard_cache.clear()
+
+# Once a billing run has invoiced a period, its invoices decide who owes what:
+# an unpaid invoice means the customer owes its balance. Before that, an active
+# customer with no payment for the period owes their monthly charge.
+@app.before_request
+def _forget_billed_periods():
+    g.pop('billed_periods', None)
+
+def period_billed(month, year):
+    """Has a billing run invoiced this period? Read once per request."""
+    billed = g.setdefault('billed_periods', {})
+    if (year, month) not in billed:
+        billed[(year, month)] = db.session.query(db.session.query(Invoice.id).filter(
+            Invoice.billing_period_month == month, Invoice.billing_period_year == year
+        ).exists()).scalar()
+    return billed[(year, month)]
+
+def invoice_for_period(month, year, *conditions):
+    """Correlated EXISTS over the outer Customer's invoice for the period."""
+    return db.session.query(Invoice.id).filter(
+        Invoice.customer_id == Customer.id, Invoice.billing_period_month == month,
+        Invoice.billing_period_year == year, *conditions
+    ).exists()
+
+def owes_for_period(month, year):
+    """Condition on the outer Customer: do they still owe for the given billing period?"""
+    if period_billed(month, year):
+        return invoice_for_period(month, year, Invoice.status != 'paid')
+    return and_(Customer.status == 'Active', ~paid_for_period(month, year))
+
+def settled_for_period(month, year):
+    """Condition on the outer Customer: have they paid in full for the given billing period?"""
+    if period_billed(month, year):
+        return invoice_for_period(month, year, Invoice.status == 'paid')
+    return paid_for_period(month, year)
+
+def outstanding_customers_query(month, year):
+    """Customers who still owe for the given billing period, by name, with the amount due."""
+    columns = (Customer.id, Customer.name, Customer.phone_number, Customer.address, Customer.plan_details,
+               Customer.set_top_box_number)
+    if period_billed(month, year):
+        return db.session.query(*columns, (Invoice.amount_due - Invoice.amount_paid).label('amount_due')).join(
+            Invoice, and_(Invoice.customer_id == Customer.id, Invoice.billing_period_month == month,
+                          Invoice.billing_period_year == year)
+        ).filter(Invoice.status != 'paid').order_by(Customer.name, Customer.id)
+    return db.session.query(*columns, Customer.monthly_charge.label('amount_due')).filter(
+        owes_for_period(month, year)
+    ).order_by(Customer.name, Customer.id)
+
+# --- Customer Search ---
+# SQLite keeps an FTS5 shadow table in sync with the customer table through
+# triggers; PostgreSQL uses pg_trgm indexes. Both rank results and prefix-match
+# STB and phone numbers. Without either index we fall back to plain ILIKE.
+SEARCH_WEIGHTS = {'name': 10.0, 'set_top_box_number': 8.0, 'phone_number': 8.0, 'address': 1.0}
+_search_installed = {}
+
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE customer_search USING fts5(
+        name, set_top_box_number, phone_number, address, tokenize = 'unicode61')""",
+    """CREATE TRIGGER customer_search_ai AFTER INSERT ON customer BEGIN
+        INSERT INTO customer_search (rowid, name, set_top_box_number, phone_number, address)
+        VALUES (new.id, new.name, new.set_top_box_number, new.phone_number, new.address);
+    END""",
+    """CREATE TRIGGER customer_search_ad AFTER DELETE ON customer BEGIN
+        DELETE FROM customer_search WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER customer_search_au AFTER UPDATE ON customer BEGIN
+        DELETE FROM customer_search WHERE rowid = old.id;
+        INSERT INTO customer_search (rowid, name, set_top_box_number, phone_number, address)
+        VALUES (new.id, new.name, new.set_top_box_number, new.phone_number, new.address);
+    END""",
+    """INSERT INTO customer_search (rowid, name, set_top_box_number, phone_number, address)
+        SELECT id, name, set_top_box_number, phone_number, address FROM customer""",
+]
+
+POSTGRES_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_customer_name_trgm ON customer USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_customer_address_trgm ON customer USING gin (address gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_customer_stb_prefix ON customer (lower(set_top_box_number) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_customer_phone_prefix ON customer (phone_number text_pattern_ops)",
+]
+
+def install_search_index():
+    """Create the dialect-specific search index if it is missing."""
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as conn:
+        if dialect == 'sqlite':
+            exists = conn.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_search'"
+            )).first()
+            if not exists:
+                for statement in SQLITE_SEARCH_DDL:
+                    conn.execute(db.text(statement))
+        elif dialect == 'postgresql':
+            for statement in POSTGRES_SEARCH_DDL:
+                conn.execute(db.text(statement))
+    _search_installed.clear()
+
+def search_index_available():
+    dialect = db.engine.dialect.name
+    if dialect not in _search_installed:
+        if dialect == 'sqlite':
+            _search_installed[dialect] = db.session.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_search'"
+            )).first() is not None
+        elif dialect == 'postgresql':
+            _search_installed[dialect] = db.session.execute(db.text(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+            )).first() is not None
+        else:
+            _search_installed[dialect] = False
+    return _search_installed[dialect]
+
+def search_customers(query, term, fields=tuple(SEARCH_WEIGHTS), ranked=True):
+    """Filter a Customer query by a search term over `fields`, ordered by relevance if `ranked`."""
+    tokens = re.findall(r'\w+', term)
+    if not tokens:
+        return query
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite' and search_index_available():
+        match = '{%s} : %s' % (' '.join(fields), ' '.join(f'"{t}"*' for t in tokens))
+        weights = ', '.join(str(SEARCH_WEIGHTS[f] if f in fields else 0.0) for f in SEARCH_WEIGHTS)
+        hits = db.text(
+            f"SELECT rowid AS customer_id, bm25(customer_search, {weights}) AS rank "
+            "FROM customer_search WHERE customer_search MATCH :match"
+        ).bindparams(match=match).columns(customer_id=db.Integer, rank=db.Float).subquery()
+        query = query.join(hits, hits.c.customer_id == Customer.id)
+        return query.order_by(hits.c.rank) if ranked else query
+    pattern = f"%{term}%"
+    prefix = f"{term.lower()}%"
+    filters = {
+        'name': Customer.name.ilike(pattern),
+        'address': Customer.address.ilike(pattern),
+        'set_top_box_number': db.func.lower(Customer.set_top_box_number).like(prefix),
+        'phone_number': Customer.phone_number.like(f"{term}%"),
+    }
+    query = query.filter(or_(*(filters[f] for f in fields)))
+    if ranked and dialect == 'postgresql' and search_index_available():
+        query = query.order_by(db.func.similarity(Customer.name, term).desc())
+    return query
+
+# --- Customer Pagination ---
+CUSTOMERS_PER_PAGE = 50
+
+def customer_columns(*extra):
+    return (Customer.id, Customer.name, Customer.set_top_box_number, Customer.monthly_charge, Customer.status) + extra
+
+def keyset_page(query, per_page=CUSTOMERS_PER_PAGE):
+    """Seek-paginate a Customer query on (name, id) using the after_name/after_id request args.
+
+    Returns the rows for this page and the cursor for the next one (None on the last page).
+    """
+    after_name = request.args.get('after_name')
+    after_id = request.args.get('after_id', type=int)
+    if after_name is not None and after_id is not None:
+        query = query.filter(tuple_(Customer.name, Customer.id) > (after_name, after_id))
+    rows = query.order_by(Customer.name, Customer.id).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = {'after_name': rows[-1].name, 'after_id': rows[-1].id}
+    return rows, next_cursor
+
+# --- Collections Rollup ---
+# Every payment insert/delete adjusts a 'day' and a 'month' row in
+# CollectionRollup inside the same transaction, so report totals for any range
+# are a grouped SUM over whole months plus the partial days at either end.
+ROLLUP_KEY = ('period', 'period_start', 'payment_method', 'operator_id')
+
+def adjust_collection_rollup(entries):
+    """Apply (payment_date, payment_method, operator_id, amount, count) deltas to the rollup."""
+    totals = {}
+    for payment_date, method, operator_id, amount, count in entries:
+        for period, start in (('day', payment_date), ('month', payment_date.replace(day=1))):
+            total = totals.setdefault((period, start, method, operator_id), [0.0, 0])
+            total[0] += amount
+            total[1] += count
+    if not totals:
+        return
+    table = CollectionRollup.__table__
+    insert = (pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert)(table)
+    upsert = insert.on_conflict_do_update(index_elements=list(ROLLUP_KEY), set_={
+        'total_amount': table.c.total_amount + insert.excluded.total_amount,
+        'payment_count': table.c.payment_count + insert.excluded.payment_count,
+    })
+    db.session.connection().execute(upsert, [
+        dict(zip(ROLLUP_KEY, key), total_amount=amount, payment_count=count)
+        for key, (amount, count) in totals.items()
+    ])
+
+@event.listens_for(db.session, 'before_flush')
+def _rollup_flushed_payments(session, flush_context, instances):
+    entries = []
+    # Archived payments stay in the rollup, so deleting one (with its customer) subtracts it too.
+    for payments, models, sign in ((session.new, Payment, 1), (session.deleted, (Payment, PaymentArchive), -1)):
+        for payment in payments:
+            if isinstance(payment, models):
+                customer = session.get(Customer, payment.customer_id)
+                # Column defaults aren't applied until the INSERT, so mirror payment_method's here.
+                entries.append((payment.payment_date, payment.payment_method or 'Cash', customer.operator_id,
+                                sign * payment.amount_paid, sign))
+    adjust_collection_rollup(entries)
+
+def month_start(column):
+    if db.engine.dialect.name == 'postgresql':
+        return db.cast(db.func.date_trunc('month', column), db.Date)
+    return db.func.date(column, 'start of month')
+
+def rebuild_collection_rollup():
+    """Recompute the whole rollup from the payment table."""
+    db.session.execute(db.delete(CollectionRollup))
+    payments = db.union_all(*[
+        db.select(model.id, model.customer_id, model.payment_date, model.payment_method, model.amount_paid)
+        for model in (Payment, PaymentArchive)
+    ]).subquery()
+    for period, start in (('day', payments.c.payment_date), ('month', month_start(payments.c.payment_date))):
+        db.session.execute(db.insert(CollectionRollup).from_select(
+            ['period', 'period_start', 'payment_method', 'operator_id', 'total_amount', 'payment_count'],
+            db.select(
+                db.literal(period), start, payments.c.payment_method, Customer.operator_id,
+                db.func.sum(payments.c.amount_paid), db.func.count(payments.c.id)
+            ).join(Customer, payments.c.customer_id == Customer.id).group_by(start, payments.c.payment_method, Customer.operator_id)
+        ))
+    db.session.commit()
+
+def collections_summary(start_date, end_date, history=False):
+    """Rows of (payment_method, operator_id, username, total_amount, payment_count) for a date range.
+
+    The rollup includes archived payments; unless `history` is set, their sums
+    over the range are subtracted so the totals match the hot-table list.
+    """
+    first_month = start_date if start_date.day == 1 else (start_date.replace(day=28) + timedelta(days=4)).replace(day=1)
+    after_last_month = (end_date + timedelta(days=1)).replace(day=1)
+    is_day = CollectionRollup.period == 'day'
+    if first_month < after_last_month:
+        in_range = or_(
+            and_(CollectionRollup.period == 'month', CollectionRollup.period_start >= first_month,
+                 CollectionRollup.period_start < after_last_month),
+            and_(is_day, CollectionRollup.period_start >= start_date, CollectionRollup.period_start < first_month),
+            and_(is_day, CollectionRollup.period_start >= after_last_month, CollectionRollup.period_start <= end_date),
+        )
+    else:
+        in_range = and_(is_day, CollectionRollup.period_start.between(start_date, end_date))
+    totals = db.select(CollectionRollup.payment_method, CollectionRollup.operator_id,
+                       CollectionRollup.total_amount, CollectionRollup.payment_count).where(in_range)
+    # The archive never holds the current month or later, so recent ranges skip it.
+    if not history and start_date < date.today().replace(day=1):
+        totals = db.union_all(totals, db.select(
+            PaymentArchive.payment_method, Customer.operator_id,
+            -db.func.sum(PaymentArchive.amount_paid), -db.func.count(PaymentArchive.id)
+        ).join(Customer, PaymentArchive.customer_id == Customer.id).where(
+            PaymentArchive.payment_date.between(start_date, end_date)
+        ).group_by(PaymentArchive.payment_method, Customer.operator_id))
+    totals = totals.subquery()
+    return db.session.query(
+        totals.c.payment_method, totals.c.operator_id, User.username,
+        db.func.sum(totals.c.total_amount).label('total_amount'),
+        db.func.sum(totals.c.payment_count).label('payment_count')
+    ).outerjoin(User, User.id == totals.c.operator_id).group_by(
+        totals.c.payment_method, totals.c.operator_id, User.username
+    ).having(db.func.sum(totals.c.payment_count) != 0).all()
+
+# --- Data Versions & HTTP Caching ---
+# Every transaction that writes customers or payments bumps the DataVersion row
+# of each operator it touched. Admins see scope 0, whose version is the sum of
+# all operators' versions, so writers never share a row lock. Pages derive
+# their ETag from the viewer's version, so an unchanged page is answered with
+# a 304 and never rendered. Expensive template fragments are cached under the same
+# version; commits also drop the touched scopes' fragments from this worker.
+_template_dir = os.path.join(app.root_path, app.template_folder)
+RELEASE = os.environ.get('RELEASE') or str(int(max(
+    os.path.getmtime(path) for path in [__file__] + [os.path.join(_template_dir, name) for name in os.listdir(_template_dir)]
+)))
+_fragment_cache = OrderedDict()
+_fragment_cache_lock = threading.Lock()
+
+def bump_data_versions(operator_ids):
+    """Bump the given operators' versions inside the current transaction."""
+    scopes = {operator_id for operator_id in operator_ids if operator_id is not None}
+    if not scopes:
+        return
+    now = datetime.now()
+    table = DataVersion.__table__
+    insert = (pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert)(table)
+    upsert = insert.on_conflict_do_update(index_elements=['scope'], set_={
+        'version': table.c.version + 1, 'changed_at': insert.excluded.changed_at,
+    })
+    db.session.connection().execute(upsert, [{'scope': scope, 'version': 1, 'changed_at': now} for scope in sorted(scopes)])
+    db.session.info.setdefault('changed_scopes', set()).update(scopes | {0})
+
+@event.listens_for(db.session, 'before_flush')
+def _bump_flushed_versions(session, flush_context, instances):
+    operator_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        if isinstance(obj, Customer):
+            operator_ids.add(obj.operator_id)
+        elif isinstance(obj, Payment):
+            operator_ids.add(session.get(Customer, obj.customer_id).operator_id)
+    if operator_ids:
+        bump_data_versions(operator_ids)
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_changed_fragments(session):
+    scopes = session.info.pop('changed_scopes', None)
+    if scopes:
+        invalidate_fragment_cache(scopes)
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_scopes(session):
+    session.info.pop('changed_scopes', None)
+
+@app.before_request
+def _forget_data_versions():
+    g.pop('data_versions', None)
+
+def viewer_scope():
+    return 0 if current_user.is_admin else current_user.id
+
+def data_version(scope):
+    """(version, changed_at) for an operator, or for everyone with scope 0; read once per request."""
+    versions = g.setdefault('data_versions', {})
+    if scope not in versions:
+        query = db.session.query(db.func.sum(DataVersion.version), db.func.max(DataVersion.changed_at))
+        if scope:
+            query = query.filter(DataVersion.scope == scope)
+        version, changed_at = query.one()
+        versions[scope] = (version or 0, changed_at or datetime(2000, 1, 1))
+    return versions[scope]
+
+def current_data_version():
+    return data_version(viewer_scope())
+
+def conditional_view(view):
+    """Answer conditional GETs with 304 while the viewer's data version is unchanged.
+
+    The ETag covers the URL, the viewer, their data version, today's date and the
+    release, so date-dependent pages and deploys still produce fresh responses.
+    Pages carrying flashed messages are never cached.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        if not app.config['HTTP_CACHING'] or request.method != 'GET':
+            return view(*args, **kwargs)
+        version, changed_at = current_data_version()
+        today = datetime.combine(date.today(), datetime.min.time())
+        etag = hashlib.sha1(repr((request.full_path, current_user.id, current_user.is_admin, version,
+                                  today, RELEASE)).encode()).hexdigest()
+        last_modified = max(changed_at.replace(microsecond=0), today)
+        pending_flashes = '_flashes' in session
+        if not pending_flashes and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or pending_flashes or get_flashed_messages():
+                return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+    return decorated_view
+
+@app.template_global()
+def cached_fragment(name, *key, caller):
+    """`{% call cached_fragment('name', key...) %}` renders the block once per data version.
+
+    Data the block needs should be passed lazily (see LazyRows) so a hit skips the query too.
+    """
+    if not app.config['HTTP_CACHING']:
+        return caller()
+    scope = viewer_scope()
+    cache_key = (scope, current_data_version()[0], name) + key
+    with _fragment_cache_lock:
+        html = _fragment_cache.get(cache_key)
+        if html is not None:
+            _fragment_cache.move_to_end(cache_key)
+            return html
+    html = Markup(caller())
+    with _fragment_cache_lock:
+        _fragment_cache[cache_key] = html
+        while len(_fragment_cache) > app.config['FRAGMENT_CACHE_SIZE']:
+            _fragment_cache.popitem(last=False)
+    return html
+
+def invalidate_fragment_cache(scopes=None):
+    with _fragment_cache_lock:
+        for cache_key in list(_fragment_cache):
+            if scopes is None or cache_key[0] in scopes:
+                del _fragment_cache[cache_key]
+
+class LazyRows:
+    """A query result that is only fetched when a template first uses it."""
+    def __init__(self, query):
+        self.query = query
+        self._rows = None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = self.query.all()
+        return self._rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+
+# --- Payment Archive ---
+# `flask archive-payments` moves payments that are both dated and billed before
+# the start of the hot window (PAYMENT_ARCHIVE_MONTHS full months before the
+# current one) into PaymentArchive, keeping their ids. The live table stays
+# small, so the log and the reports' detail lists read it alone unless history
+# is asked for. The collections rollup keeps archived amounts; report totals
+# subtract them again when history is off. Paid-for-period
+# checks add the archive only for periods older than the newest archived one.
+PAYMENTS_PER_PAGE = 15
+ESTIMATED_COUNT_CAP = 1000
+ARCHIVE_BATCH_SIZE = 1000
+
+def archive_cutoff(months):
+    """First day of the hot window: `months` full months before the current month."""
+    first = date.today().replace(day=1)
+    total = first.year * 12 + first.month - 1 - months
+    return date(total // 12, total % 12 + 1, 1)
+
+def archived_through():
+    """(year, month) of the newest billing period in the archive, or None."""
+    row = db.session.query(PaymentArchive.billing_period_year, PaymentArchive.billing_period_month).order_by(
+        PaymentArchive.billing_period_year.desc(), PaymentArchive.billing_period_month.desc()
+    ).first()
+    return tuple(row) if row else None
+
+def period_archived(month, year):
+    # The archive never holds the current month or later, so those skip the lookup.
+    today = date.today()
+    if (year, month) >= (today.year, today.month):
+        return False
+    newest = archived_through()
+    return newest is not None and (year, month) <= newest
+
+def payment_models(include_archive):
+    return (Payment, PaymentArchive) if include_archive else (Payment,)
+
+def archive_payments(before, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move payments dated and billed before `before` into the archive; returns the number moved."""
+    columns = [column.name for column in Payment.__table__.columns]
+    old = and_(Payment.payment_date < before,
+               tuple_(Payment.billing_period_year, Payment.billing_period_month) < (before.year, before.month))
+    moved = 0
+    while True:
+        ids = [payment_id for payment_id, in
+               db.session.query(Payment.id).filter(old).order_by(Payment.id).limit(batch_size)]
+        if not ids:
+            return moved
+        db.session.execute(db.insert(PaymentArchive).from_select(
+            columns, db.select(*[Payment.__table__.c[name] for name in columns]).where(Payment.id.in_(ids))
+        ))
+        bump_data_versions(operator_id for operator_id, in db.session.query(Customer.operator_id).join(
+            Payment).filter(Payment.id.in_(ids)).distinct())
+        db.session.execute(db.delete(Payment).where(Payment.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+
+def ensure_payment_autoincrement():
+    """Rebuild an older SQLite payment table with AUTOINCREMENT so archived ids are never reused.
+
+    Also keeps SQLite's id sequence above every archived id, and gives fresh ids
+    to live payments that already reused an archived one. Safe to run repeatedly.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    with db.engine.begin() as connection:
+        ddl = connection.execute(db.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'payment'"
+        )).scalar()
+        if 'AUTOINCREMENT' not in ddl.upper():
+            columns = ', '.join(column.name for column in Payment.__table__.columns)
+            for index in Payment.__table__.indexes:
+                connection.execute(db.text(f'DROP INDEX IF EXISTS {index.name}'))
+            connection.execute(db.text('ALTER TABLE payment RENAME TO payment_old'))
+            Payment.__table__.create(connection)
+            connection.execute(db.text(f'INSERT INTO payment ({columns}) SELECT {columns} FROM payment_old'))
+            connection.execute(db.text('DROP TABLE payment_old'))
+        connection.execute(db.text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'payment', 0 "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'payment')"
+        ))
+        connection.execute(db.text(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT COALESCE(MAX(id), 0) FROM payment_archive)) "
+            "WHERE name = 'payment'"
+        ))
+        new_columns = ', '.join(column.name for column in Payment.__table__.columns if column.name != 'id')
+        connection.execute(db.text(
+            f'INSERT INTO payment ({new_columns}) SELECT {new_columns} FROM payment '
+            'WHERE id IN (SELECT id FROM payment_archive) ORDER BY id'
+        ))
+        connection.execute(db.text('DELETE FROM payment WHERE id IN (SELECT id FROM payment_archive)'))
+
+def estimated_count(query):
+    """Cheap row count for pagination labels: (count, is_exact).
+
+    PostgreSQL returns the planner's estimate. Elsewhere rows are counted up to
+    ESTIMATED_COUNT_CAP, and a larger count is reported as inexact.
+    """
+    statement = query.order_by(None).statement
+    if db.engine.dialect.name == 'postgresql':
+        compiled = statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+        plan = db.session.execute(db.text(f'EXPLAIN (FORMAT JSON) {compiled}')).scalar()
+        return int(plan[0]['Plan']['Plan Rows']), False
+    capped = db.session.query(db.func.count()).select_from(statement.limit(ESTIMATED_COUNT_CAP + 1).subquery()).scalar()
+    return min(capped, ESTIMATED_COUNT_CAP), capped <= ESTIMATED_COUNT_CAP
+
+def payment_log_page(query, model, per_page=PAYMENTS_PER_PAGE):
+    """Seek-paginate a payment query, newest first, using the before_date/before_id request args.
+
+    Returns the rows for this page and the cursor for the next one (None on the last page).
+    """
+    before_id = request.args.get('before_id', type=int)
+    try:
+        before_date = datetime.strptime(request.args.get('before_date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        before_date = None
+    if before_date is not None and before_id is not None:
+        query = query.filter(tuple_(model.payment_date, model.id) < (before_date, before_id))
+    rows = query.order_by(model.payment_date.desc(), model.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = {'before_date': rows[-1].payment_date.isoformat(), 'before_id': rows[-1].id}
+    return rows, next_cursor
+
+# --- Billing ---
+# A billing run creates one invoice per active customer for a period with a
+# single INSERT ... SELECT, skipping customers already invoiced, so re-running
+# it is harmless. Payments for the period recorded before the run are counted
+# in. Later payments are added to their own period's invoice as they are
+# recorded, so each payment counts exactly once. Paying more than is due
+# leaves a credit (a negative balance) on that invoice.
+def invoice_status(amount_paid, amount_due):
+    return case((amount_paid >= amount_due, 'paid'), (amount_paid > 0, 'partial'), else_='open')
+
+def run_billing(month, year):
+    """Invoice every active customer for the period; returns the number of invoices created."""
+    period_payments = db.union_all(*[
+        db.select(model.customer_id, model.amount_paid).where(
+            model.billing_period_month == month, model.billing_period_year == year
+        ) for model in payment_models(period_archived(month, year))
+    ]).subquery()
+    period_paid = db.select(
+        period_payments.c.customer_id, db.func.sum(period_payments.c.amount_paid).label('paid')
+    ).group_by(period_payments.c.customer_id).subquery()
+    paid = db.func.coalesce(period_paid.c.paid, 0.0)
+    already_invoiced = db.select(Invoice.id).where(
+        Invoice.customer_id == Customer.id, Invoice.billing_period_month == month, Invoice.billing_period_year == year
+    ).exists()
+    result = db.session.execute(db.insert(Invoice).from_select(
+        ['customer_id', 'billing_period_month', 'billing_period_year', 'amount_due', 'amount_paid', 'status', 'created_at'],
+        db.select(
+            Customer.id, db.literal(month), db.literal(year), Customer.monthly_charge, paid,
+            invoice_status(paid, Customer.monthly_charge), db.literal(datetime.now(), db.DateTime)
+        ).outerjoin(period_paid, period_paid.c.customer_id == Customer.id).where(
+            Customer.status == 'Active', ~already_invoiced
+        )
+    ))
+    if result.rowcount:
+        bump_data_versions(operator_id for operator_id, in db.session.query(Customer.operator_id).filter(
+            Customer.status == 'Active').distinct())
+    db.session.commit()
+    g.pop('billed_periods', None)
+    return result.rowcount
+
+def allocate_payments(entries):
+    """Add (customer_id, month, year, amount) payments to their period's invoice, if one exists.
+
+    Runs inside the caller's transaction, with one query for all the entries.
+    """
+    totals = {}
+    for customer_id, month, year, amount in entries:
+        key = (customer_id, year, month)
+        totals[key] = totals.get(key, 0.0) + amount
+    if not totals:
+        return
+    invoices = Invoice.query.filter(
+        tuple_(Invoice.customer_id, Invoice.billing_period_year, Invoice.billing_period_month).in_(list(totals))
+    ).with_for_update().all()
+    for invoice in invoices:
+        invoice.amount_paid += totals[(invoice.customer_id, invoice.billing_period_year, invoice.billing_period_month)]
+        invoice.status = 'paid' if invoice.amount_paid >= invoice.amount_due else 'partial'
+
+def billing_summary(limit=12):
+    """Per-period invoice counts and totals for the most recent billing runs."""
+    return db.session.query(
+        Invoice.billing_period_year, Invoice.billing_period_month,
+        db.func.count(Invoice.id).label('invoices'),
+        db.func.sum(case((Invoice.status != 'paid', 1), else_=0)).label('unpaid'),
+        db.func.sum(Invoice.amount_due).label('amount_due'),
+        db.func.sum(Invoice.amount_paid).label('amount_paid')
+    ).group_by(Invoice.billing_period_year, Invoice.billing_period_month).order_by(
+        Invoice.billing_period_year.desc(), Invoice.billing_period_month.desc()
+    ).limit(limit).all()
+
+# --- Bulk Import ---
+# Rows are validated and inserted in chunks: one set query per chunk checks STB
+# uniqueness (or resolves payment customers), then a single executemany insert
+# and commit. Bad rows are reported back by row number instead of aborting.
+BULK_CHUNK_SIZE = 500
+CUSTOMER_STATUSES = ('Active', 'Inactive', 'Suspended')
+PAYMENT_METHODS = ('Cash', 'Online')
+CUSTOMER_IMPORT_COLUMNS = ('name', 'address', 'phone_number', 'plan_details', 'monthly_charge',
+                           'set_top_box_number', 'connection_date', 'status', 'notes')
+PAYMENT_IMPORT_COLUMNS = ('customer_id', 'set_top_box_number', 'payment_date', 'amount_paid',
+                          'billing_period_month', 'billing_period_year', 'payment_method', 'transaction_reference')
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _field(row, name, required=False):
+    if not isinstance(row, dict):
+        raise ValueError('Each row must be an object of named fields.')
+    value = row.get(name)
+    value = str(value).strip() if value is not None else ''
+    if required and not value:
+        raise ValueError(f"'{name}' is required")
+    return value or None
+
+def _typed_field(row, name, parse, label, required=False):
+    value = _field(row, name, required)
+    if value is None:
+        return None
+    try:
+        return parse(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be {label}, got {value!r}")
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def _parse_amount(value):
+    amount = float(value)
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError(value)
+    return amount
+
+def validate_customer_row(row, operator_id):
+    status = _field(row, 'status') or 'Active'
+    if status not in CUSTOMER_STATUSES:
+        raise ValueError(f"'status' must be one of {', '.join(CUSTOMER_STATUSES)}")
+    return {
+        'operator_id': operator_id,
+        'name': _field(row, 'name', required=True),
+        'address': _field(row, 'address', required=True),
+        'phone_number': _field(row, 'phone_number'),
+        'plan_details': _field(row, 'plan_details'),
+        'monthly_charge': _typed_field(row, 'monthly_charge', _parse_amount, 'a non-negative number', required=True),
+        'set_top_box_number': _field(row, 'set_top_box_number', required=True),
+        'connection_date': _typed_field(row, 'connection_date', _parse_date, 'a YYYY-MM-DD date'),
+        'status': status,
+        'notes': _field(row, 'notes'),
+    }
+
+def validate_payment_row(row):
+    payment_date = _typed_field(row, 'payment_date', _parse_date, 'a YYYY-MM-DD date', required=True)
+    month = _typed_field(row, 'billing_period_month', int, 'a month number') or payment_date.month
+    if not 1 <= month <= 12:
+        raise ValueError("'billing_period_month' must be between 1 and 12")
+    method = _field(row, 'payment_method') or 'Cash'
+    if method not in PAYMENT_METHODS:
+        raise ValueError(f"'payment_method' must be one of {', '.join(PAYMENT_METHODS)}")
+    customer_id = _typed_field(row, 'customer_id', int, 'a number')
+    set_top_box_number = _field(row, 'set_top_box_number')
+    if customer_id is None and set_top_box_number is None:
+        raise ValueError("'customer_id' or 'set_top_box_number' is required")
+    return {
+        'customer_id': customer_id,
+        'set_top_box_number': set_top_box_number,
+        'payment_date': payment_date,
+        'amount_paid': _typed_field(row, 'amount_paid', _parse_amount, 'a non-negative number'),
+        'billing_period_month': month,
+        'billing_period_year': _typed_field(row, 'billing_period_year', int, 'a year') or payment_date.year,
+        'payment_method': method,
+        'transaction_reference': _field(row, 'transaction_reference'),
+    }
+
+def _insert_chunk(model, numbered_values, report, before_commit=None):
+    """Insert (line, values) pairs in one transaction; `before_commit(numbered_values)` runs inside it.
+
+    If the database rejects the batch, the rows are retried one per transaction
+    so only the offending rows are reported.
+    """
+    if not numbered_values:
+        return
+    try:
+        db.session.execute(db.insert(model), [values for _, values in numbered_values])
+        if before_commit:
+            before_commit(numbered_values)
+        db.session.commit()
+        report['inserted'] += len(numbered_values)
+        return
+    except IntegrityError:
+        db.session.rollback()
+    for line, values in numbered_values:
+        try:
+            db.session.execute(db.insert(model), [values])
+            if before_commit:
+                before_commit([(line, values)])
+            db.session.commit()
+            report['inserted'] += 1
+        except IntegrityError as exc:
+            db.session.rollback()
+            report['errors'].append({'row': line, 'error': f"Row could not be saved: {exc.orig}"})
+
+def import_customers(rows, operator_id):
+    """Insert customer dicts for an operator; returns {'inserted': n, 'errors': [{'row', 'error'}]}."""
+    report = {'inserted': 0, 'errors': []}
+    seen_stbs = set()
+    for chunk in chunked(enumerate(rows, 1), BULK_CHUNK_SIZE):
+        valid = []
+        for line, row in chunk:
+            try:
+                values = validate_customer_row(row, operator_id)
+            except ValueError as exc:
+                report['errors'].append({'row': line, 'error': str(exc)})
+                continue
+            if values['set_top_box_number'] in seen_stbs:
+                report['errors'].append({'row': line, 'error': 'Duplicate Set-Top Box number in this import.'})
+                continue
+            seen_stbs.add(values['set_top_box_number'])
+            valid.append((line, values))
+        existing = set(db.session.scalars(db.select(Customer.set_top_box_number).where(
+            Customer.set_top_box_number.in_([values['set_top_box_number'] for _, values in valid])
+        )))
+        to_insert = []
+        for line, values in valid:
+            if values['set_top_box_number'] in existing:
+                report['errors'].append({'row': line, 'error': 'A customer with this Set-Top Box number already exists.'})
+            else:
+                to_insert.append((line, values))
+        _insert_chunk(Customer, to_insert, report, before_commit=lambda batch: bump_data_versions([operator_id]))
+    report['errors'].sort(key=lambda error: error['row'])
+    return report
+
+def import_payments(rows, user):
+    """Insert payment dicts received by `user`; returns the same report shape as import_customers."""
+    report = {'inserted': 0, 'errors': []}
+    for chunk in chunked(enumerate(rows, 1), BULK_CHUNK_SIZE):
+        valid = []
+        for line, row in chunk:
+            try:
+                valid.append((line, validate_payment_row(row)))
+            except ValueError as exc:
+                report['errors'].append({'row': line, 'error': str(exc)})
+        ids = {values['customer_id'] for _, values in valid if values['customer_id'] is not None}
+        stbs = {values['set_top_box_number'] for _, values in valid if values['customer_id'] is None}
+        customers = db.session.query(
+            Customer.id, Customer.set_top_box_number, Customer.operator_id, Customer.monthly_charge
+        ).filter(or_(Customer.id.in_(ids), Customer.set_top_box_number.in_(stbs)))
+        if not user.is_admin:
+            customers = customers.filter(Customer.operator_id == user.id)
+        by_id, by_stb = {}, {}
+        for c in customers:
+            by_id[c.id] = by_stb[c.set_top_box_number] = c
+        to_insert, operators = [], {}
+        for line, values in valid:
+            stb = values.pop('set_top_box_number')
+            customer = by_id.get(values['customer_id']) if values['customer_id'] is not None else by_stb.get(stb)
+            if customer is None:
+                report['errors'].append({'row': line, 'error': 'Customer not found.'})
+                continue
+            values['customer_id'] = customer.id
+            if values['amount_paid'] is None:
+                values['amount_paid'] = customer.monthly_charge
+            values['user_id'] = user.id
+            values['received_by'] = user.username
+            to_insert.append((line, values))
+            operators[line] = customer.operator_id
+
+        def before_commit(batch):
+            adjust_collection_rollup([(values['payment_date'], values['payment_method'], operators[line],
+                                       values['amount_paid'], 1) for line, values in batch])
+            bump_data_versions({operators[line] for line, _ in batch})
+            allocate_payments([(values['customer_id'], values['billing_period_month'], values['billing_period_year'],
+                                values['amount_paid']) for _, values in batch])
+        _insert_chunk(Payment, to_insert, report, before_commit=before_commit)
+    report['errors'].sort(key=lambda error: error['row'])
+    return report
+
+def read_import_file(stream, filename):
+    """Rows from an uploaded or local file: a JSON array of objects, otherwise CSV with a header row."""
+    if filename.lower().endswith('.json'):
+        rows = json.load(stream)
+        if not isinstance(rows, list):
+            raise ValueError('JSON imports must be an array of objects.')
+        return rows
+    return csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+def bulk_import_view(kind, columns, run_import):
+    if request.method == 'POST':
+        try:
+            if request.is_json:
+                rows = request.get_json()
+                if not isinstance(rows, list):
+                    raise ValueError('JSON imports must be an array of objects.')
+            else:
+                upload = request.files.get('file')
+                if not upload or not upload.filename:
+                    raise ValueError('Please choose a CSV or JSON file to import.')
+                rows = read_import_file(upload.stream, upload.filename)
+            report = run_import(rows)
+        except (ValueError, UnicodeDecodeError, csv.Error) as exc:
+            if request.is_json:
+                return jsonify(error=str(exc)), 400
+            flash(str(exc), 'danger')
+            return render_template('bulk_import.html', kind=kind, columns=columns, report=None)
+        if request.is_json:
+            return jsonify(report)
+        flash(f"Imported {report['inserted']} {kind}; {len(report['errors'])} row(s) had errors.",
+              'success' if not report['errors'] else 'warning')
+        return render_template('bulk_import.html', kind=kind, columns=columns, report=report)
+    return render_template('bulk_import.html', kind=kind, columns=columns, report=None)
+
+def print_import_report(report):
+    for error in report['errors']:
+        print(f"Row {error['row']}: {error['error']}")
+    print(f"Imported {report['inserted']} row(s); {len(report['errors'])} error(s).")
+
+# --- Benchmarking ---
+# A seeded synthetic data generator plus a harness that drives the main pages
+# through app.test_client(), used by the seed-data, bench and
+# check-query-budgets commands. Point DATABASE_URL at a scratch SQLite file or
+# a local PostgreSQL database before seeding.
+PAYMENT_METHOD_WEIGHTS = (('Cash', 0.7), ('Online', 0.3))
+
+def main_page_budgets():
+    """The main pages as {url: max SQL statements}, including the login lookup."""
+    today = date.today()
+    return {
+        '/index': 6,
+        '/customers': 3,
+        '/customers?search_customers=a': 4,
+        '/api/customers': 3,
+        '/payments/record': 2,
+        '/payments/log': 4,
+        f'/reports/outstanding?month={today.month}&year={today.year}': 4,
+        f'/reports/collections?start_date={today.replace(day=1)}&end_date={today}': 4,
+    }
+
+def logged_in_client(user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
+
+def fetch_uncached(client, url):
+    """GET `url` as a fresh request would: empty identity map, dashboard, fragment and login caches."""
+    db.session.remove()
+    g.pop('_login_user', None)
+    with client.session_transaction() as client_session:
+        user_id = client_session.get('_user_id')
+    if user_id is not None:
+        invalidate_cached_user(int(user_id))
+    invalidate_dashboard_cache()
+    invalidate_fragment_cache()
+    return client.get(url)
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+def seed_synthetic_data(operators, customers, months, seed=42):
+    """Bulk-insert operators, customers and `months` of payments history; returns row counts."""
+    rng = random.Random(seed)
+    password_hash = generate_password_hash('operator')
+    operator_ids = []
+    for n in range(1, operators + 1):
+        user = User.query.filter_by(username=f'operator{n}').first()
+        if not user:
+            user = User(username=f'operator{n}', password_hash=password_hash)
+            db.session.add(user)
+            db.session.flush()
+        operator_ids.append(user.id)
+    db.session.commit()
+    first_id = (db.session.query(db.func.max(Customer.id)).scalar() or 0) + 1
+    for chunk in chunked(range(first_id, first_id + customers), BULK_CHUNK_SIZE * 10):
+        db.session.execute(db.insert(Customer), [{
+            'operator_id': rng.choice(operator_ids), 'name': f'Customer {n:07d}',
+            'address': f'{rng.randint(1, 999)} Street {rng.randint(1, 200)}',
+            'phone_number': f'9{rng.randint(100000000, 999999999)}', 'plan_details': rng.choice(('Basic', 'Family', 'Sports')),
+            'monthly_charge': rng.choice((150.0, 250.0, 350.0)), 'set_top_box_number': f'SYN{n:08d}',
+            'status': rng.choices(CUSTOMER_STATUSES, weights=(85, 10, 5))[0],
+        } for n in chunk])
+        db.session.commit()
+    today = date.today()
+    periods = []
+    for back in range(months):
+        year, month = divmod(today.year * 12 + today.month - 1 - back, 12)
+        periods.append((year, month + 1))
+    methods, weights = zip(*PAYMENT_METHOD_WEIGHTS)
+    payments = 0
+    new_customers = db.session.query(Customer.id, Customer.monthly_charge).filter(
+        Customer.id >= first_id
+    ).order_by(Customer.id).yield_per(BULK_CHUNK_SIZE * 10)
+    for chunk in chunked(new_customers, BULK_CHUNK_SIZE * 10):
+        rows = []
+        for customer in chunk:
+            for year, month in periods:
+                if rng.random() < 0.85:
+                    paid_on = date(year, month, rng.randint(1, 28))
+                    rows.append({
+                        'customer_id': customer.id, 'payment_date': min(paid_on, today),
+                        'amount_paid': customer.monthly_charge, 'billing_period_month': month,
+                        'billing_period_year': year, 'payment_method': rng.choices(methods, weights)[0],
+                        'received_by': 'seed-data',
+                    })
+        if rows:
+            db.session.execute(db.insert(Payment), rows)
+            db.session.commit()
+            payments += len(rows)
+    rebuild_collection_rollup()
+    return {'operators': operators, 'customers': customers, 'payments': payments}
+
+def run_benchmark(user, urls, repeat):
+    """Time each url `repeat` times; returns {url: latency percentiles, query count, peak memory}."""
+    client = logged_in_client(user)
+    results = {}
+    for url in urls:
+        fetch_uncached(client, url)  # warm-up: template compilation, search index probe
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = fetch_uncached(client, url)
+            timings.append((time.perf_counter() - started) * 1000)
+        with count_queries() as counter:
+            tracemalloc.start()
+            fetch_uncached(client, url)
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        results[url] = {
+            'status': response.status_code,
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p95_ms': round(percentile(timings, 95), 2),
+            'p99_ms': round(percentile(timings, 99), 2),
+            'mean_ms': round(sum(timings) / len(timings), 2),
+            'queries': counter['count'],
+            'peak_memory_kb': round(peak_memory / 1024, 1),
+        }
+    return results
+
+def compare_benchmarks(baseline, current, threshold):
+    """Regression messages for routes whose p95 grew past `threshold`x or that issue more queries."""
+    regressions = []
+    for url, result in current.items():
+        before = baseline.get(url)
+        if not before:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * threshold:
+            regressions.append(f"{url}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result['queries'] > before['queries']:
+            regressions.append(f"{url}: queries {before['queries']} -> {result['queries']}")
+    return regressions
+
 # --- NEW: Database Initialization Command ---
 # This replaces the init_db.py file.
 @app.cli.command("init-db")
 def initialize_database():
     """Create database tables and the default admin user."""
     db.create_all()
+    install_search_index()
     print("Database tables created.")
     
     if User.query.filter_by(username='admin').first():
@@ -103,6 +1531,164 @@ def initialize_database():
         db.session.add(admin_user)
         db.session.commit()
         print("Default admin user created with username 'admin' and password 'admin'")
+
+@app.cli.command("db-upgrade")
+def upgrade_database():
+    """Bring an existing database up to the current schema without dropping data."""
+    db.create_all()
+    ensure_payment_autoincrement()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    install_search_index()
+    if not CollectionRollup.query.first() and Payment.query.first():
+        rebuild_collection_rollup()
+        print("Collections rollup built from existing payments.")
+    print("Database schema is up to date.")
+
+@app.cli.command("rebuild-rollup")
+def rebuild_rollup_command():
+    """Recompute the collections rollup table from all payments."""
+    rebuild_collection_rollup()
+    print(f"Collections rollup rebuilt ({CollectionRollup.query.count()} rows).")
+
+@app.cli.command("import-customers")
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--operator', 'operator_username', required=True, help='Username the customers belong to.')
+def import_customers_command(path, operator_username):
+    """Bulk-import customers from a CSV or JSON file."""
+    operator = User.query.filter_by(username=operator_username).first()
+    if not operator:
+        sys.exit(f"No user named '{operator_username}'.")
+    with open(path, 'rb') as stream:
+        print_import_report(import_customers(read_import_file(stream, path), operator.id))
+
+@app.cli.command("import-payments")
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='Username recorded as having received the payments.')
+def import_payments_command(path, username):
+    """Bulk-import payments from a CSV or JSON file."""
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        sys.exit(f"No user named '{username}'.")
+    with open(path, 'rb') as stream:
+        print_import_report(import_payments(read_import_file(stream, path), user))
+
+@app.cli.command("archive-payments")
+@click.option('--months', type=click.IntRange(min=1), default=lambda: app.config['PAYMENT_ARCHIVE_MONTHS'],
+              help='Full months to keep in the live table before the current one (default: PAYMENT_ARCHIVE_MONTHS).')
+@click.option('--batch-size', type=click.IntRange(min=1), default=ARCHIVE_BATCH_SIZE, help='Payments moved per transaction.')
+def archive_payments_command(months, batch_size):
+    """Move payments older than the hot window into the payment archive."""
+    before = archive_cutoff(months)
+    started = time.perf_counter()
+    moved = archive_payments(before, batch_size)
+    print(f"Archived {moved} payment(s) dated and billed before {before} in {time.perf_counter() - started:.1f}s.")
+
+@app.cli.command("billing-run")
+@click.option('--month', type=click.IntRange(1, 12), default=lambda: date.today().month, help='Billing month (default: current).')
+@click.option('--year', type=int, default=lambda: date.today().year, help='Billing year (default: current).')
+def billing_run_command(month, year):
+    """Create invoices for every active customer for a billing period (safe to re-run)."""
+    started = time.perf_counter()
+    created = run_billing(month, year)
+    print(f"Created {created} invoice(s) for {month_name[month]} {year} in {time.perf_counter() - started:.1f}s.")
+
+@app.cli.command("worker")
+@click.option('--threads', default=2, show_default=True, help='Report jobs to run at once.')
+@click.option('--poll', default=2.0, show_default=True, help='Seconds to wait when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty.')
+def worker_command(threads, poll, once):
+    """Run queued report jobs outside the web workers (set REPORT_JOB_THREADS=0 on the web side)."""
+    print(f"Report worker started with {threads} thread(s).")
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            stale = datetime.now() - REPORT_JOB_TIMEOUT
+            job_ids = db.session.scalars(db.select(ReportJob.id).where(or_(
+                ReportJob.status == 'queued', and_(ReportJob.status == 'running', ReportJob.started_at < stale)
+            )).order_by(ReportJob.id).limit(threads * 2)).all()
+            db.session.execute(db.delete(ReportJob).where(ReportJob.created_at < datetime.now() - REPORT_JOB_RETENTION))
+            db.session.commit()
+            if job_ids:
+                wait([pool.submit(run_report_job, job_id) for job_id in job_ids])
+                print(f"Processed report job(s) {', '.join(map(str, job_ids))}.")
+            elif once:
+                break
+            else:
+                time.sleep(poll)
+
+@app.cli.command("check-query-budgets")
+def check_query_budgets():
+    """Render each main page as the admin user and fail if any exceeds its SQL query budget."""
+    admin_user = User.query.filter_by(is_admin=True).first()
+    if not admin_user:
+        sys.exit("No admin user found; run 'flask init-db' first.")
+    client = logged_in_client(admin_user)
+    failures = 0
+    for url, budget in main_page_budgets().items():
+        try:
+            with query_budget(budget, label=url) as counter:
+                response = fetch_uncached(client, url)
+            print(f"{url}: {counter['count']} queries (budget {budget}), HTTP {response.status_code}")
+        except AssertionError as exc:
+            failures += 1
+            print(f"FAIL {exc}")
+    if failures:
+        sys.exit(f"{failures} route(s) exceeded their query budget.")
+
+@app.cli.command("seed-data")
+@click.option('--operators', default=5, show_default=True, help='Operator accounts to create.')
+@click.option('--customers', default=1000, show_default=True, help='Customers to add (1k-500k).')
+@click.option('--months', default=12, show_default=True, help='Months of payment history per customer.')
+@click.option('--seed', default=42, show_default=True, help='Random seed, for repeatable data sets.')
+@click.option('--force', is_flag=True, help='Seed even though the database holds real customers.')
+def seed_data_command(operators, customers, months, seed, force):
+    """Fill the database with synthetic operators, customers and payments for benchmarking."""
+    db.create_all()
+    real_customers = Customer.query.filter(~Customer.set_top_box_number.like('SYN%')).first()
+    if real_customers and not force:
+        sys.exit(f"{db.engine.url} already holds real customers; point DATABASE_URL "
+                 "at a scratch database, or pass --force to seed it anyway.")
+    install_search_index()
+    started = time.perf_counter()
+    counts = seed_synthetic_data(operators, customers, months, seed)
+    print(f"Seeded {counts['operators']} operators, {counts['customers']} customers and "
+          f"{counts['payments']} payments in {time.perf_counter() - started:.1f}s.")
+
+@app.cli.command("bench")
+@click.option('--repeat', type=click.IntRange(min=1), default=20, show_default=True, help='Timed requests per route.')
+@click.option('--user', 'username', default='admin', show_default=True, help='User to run the pages as.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to this JSON file.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='Earlier results file to compare against.')
+@click.option('--threshold', default=1.25, show_default=True, help='p95 slowdown ratio counted as a regression.')
+def bench_command(repeat, username, output, compare, threshold):
+    """Benchmark the main pages: latency percentiles, SQL statements and peak memory per route."""
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        sys.exit(f"No user named '{username}'.")
+    results = run_benchmark(user, list(main_page_budgets()), repeat)
+    for url, result in results.items():
+        print(f"{url}: p50 {result['p50_ms']}ms, p95 {result['p95_ms']}ms, p99 {result['p99_ms']}ms, "
+              f"{result['queries']} queries, peak {result['peak_memory_kb']}KB, HTTP {result['status']}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'database': db.engine.dialect.name,
+                'user': username,
+                'customers': Customer.query.count(),
+                'payments': Payment.query.count(),
+                'routes': results,
+            }, f, indent=2)
+        print(f"Results written to {output}.")
+    if compare:
+        with open(compare) as f:
+            regressions = compare_benchmarks(json.load(f)['routes'], results, threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(f"{len(regressions)} regression(s) against {compare}.")
+        print(f"No regressions against {compare}.")
 # --- End of New Section ---
 
 
@@ -115,7 +1701,9 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password):
+        with timed_phase('auth'):
+            password_ok = user is not None and user.check_password(password)
+        if password_ok:
             login_user(user)
             next_page = request.args.get('next')
             flash(f'Login successful. Welcome, {user.username}!', 'success')
@@ -170,6 +1758,7 @@ def toggle_admin(user_id):
         return redirect(url_for('manage_users'))
     user_to_modify.is_admin = not user_to_modify.is_admin
     db.session.commit()
+    invalidate_cached_user(user_to_modify.id)
     new_status = "Admin" if user_to_modify.is_admin else "Operator"
     flash(f"User '{user_to_modify.username}' has been updated to {new_status}.", "success")
     return redirect(url_for('manage_users'))
@@ -182,68 +1771,97 @@ def delete_user(user_id):
     if user_to_delete.id == current_user.id:
         flash("You cannot delete your own account.", 'danger')
         return redirect(url_for('manage_users'))
+    # Databases created before ondelete='SET NULL' still have a plain foreign key.
+    ReportJob.query.filter_by(created_by=user_to_delete.id).update({'created_by': None})
+    PaymentArchive.query.filter_by(user_id=user_to_delete.id).update({'user_id': None})
+    # Once a user owns no customers their rollup rows are all zero; older schemas still have a FK on them.
+    CollectionRollup.query.filter_by(operator_id=user_to_delete.id).delete()
     db.session.delete(user_to_delete)
     db.session.commit()
+    invalidate_cached_user(user_to_delete.id)
     flash(f"User '{user_to_delete.username}' has been deleted.", 'success')
     return redirect(url_for('manage_users'))
 
 @app.route("/")
 @app.route("/index")
 @login_required
+@conditional_view
 def index():
-    if current_user.is_admin:
-        customer_query = Customer.query
-        payment_query = Payment.query
-    else:
-        customer_query = Customer.query.filter_by(operator_id=current_user.id)
-        payment_query = Payment.query.join(Customer).filter(Customer.operator_id == current_user.id)
-    total_customers_count = customer_query.count()
-    active_customers_count = customer_query.filter(Customer.status == 'Active').count()
-    collections_today = db.session.query(db.func.sum(Payment.amount_paid)).select_from(payment_query.subquery()).filter(Payment.payment_date == date.today()).scalar() or 0.0
+    operator_id = None if current_user.is_admin else current_user.id
     current_month = datetime.now().month
     current_year = datetime.now().year
     current_billing_period_display = f"{month_name[current_month]} {current_year}"
-    paid_customer_ids_this_month = [p.customer_id for p in payment_query.filter(
-        Payment.billing_period_month == current_month, Payment.billing_period_year == current_year
-    ).all()]
-    outstanding_payments_count = customer_query.filter(
-        Customer.status == 'Active',
-        Customer.id.notin_(paid_customer_ids_this_month)
-    ).count()
+    stats = get_dashboard_stats(operator_id, current_month, current_year)
+    customer_query = db.session.query(
+        *customer_columns(settled_for_period(current_month, current_year).label('paid_current_month'))
+    )
+    if operator_id is not None:
+        customer_query = customer_query.filter(Customer.operator_id == operator_id)
     search_term_home = request.args.get('search_home', '')
     if search_term_home:
-        search_pattern = f"%{search_term_home}%"
-        customer_query = customer_query.filter(or_(
-            Customer.name.ilike(search_pattern),
-            Customer.set_top_box_number.ilike(search_pattern)
-        ))
-    customers_for_list = customer_query.order_by(Customer.name).all()
-    customers_list_on_home = [{
-        'id': c.id, 'name': c.name, 'set_top_box_number': c.set_top_box_number,
-        'monthly_charge': c.monthly_charge, 'status': c.status,
-        'paid_current_month': c.id in paid_customer_ids_this_month
-    } for c in customers_for_list]
-    return render_template('index.html', total_customers_count=total_customers_count,
-                           active_customers_count=active_customers_count, outstanding_payments_count=outstanding_payments_count,
-                           collections_today=collections_today, current_billing_period_display=current_billing_period_display,
-                           customers_list_on_home=customers_list_on_home, search_term_home=search_term_home)
+        customer_query = search_customers(customer_query, search_term_home,
+                                          fields=('name', 'set_top_box_number'), ranked=False)
+    customers_list_on_home, next_cursor = keyset_page(customer_query)
+    return render_template('index.html', current_billing_period_display=current_billing_period_display,
+                           customers_list_on_home=customers_list_on_home, search_term_home=search_term_home,
+                           next_cursor=next_cursor, **stats)
 
 
 @app.route('/customers')
 @login_required
+@conditional_view
 def customers_list():
-    query = Customer.query
+    query = db.session.query(*customer_columns(Customer.address, Customer.phone_number, Customer.plan_details))
     if not current_user.is_admin:
-        query = query.filter_by(operator_id=current_user.id)
+        query = query.filter(Customer.operator_id == current_user.id)
     search_query_customers = request.args.get('search_customers', '')
     if search_query_customers:
-        search_pattern = f"%{search_query_customers}%"
-        query = query.filter(or_(
-            Customer.name.ilike(search_pattern), Customer.set_top_box_number.ilike(search_pattern),
-            Customer.address.ilike(search_pattern), Customer.phone_number.ilike(search_pattern)
-        ))
-    customers = query.order_by(Customer.name).all()
-    return render_template('customers.html', customers=customers, search_query_customers=search_query_customers)
+        query = search_customers(query, search_query_customers, ranked=False)
+    customers, next_cursor = keyset_page(query)
+    return render_template('customers.html', customers=customers, search_query_customers=search_query_customers,
+                           next_cursor=next_cursor)
+
+
+@app.route('/api/customers')
+@login_required
+def api_customers():
+    """Keyset-paginated JSON listing of customers with only the columns the UI needs."""
+    query = db.session.query(*customer_columns())
+    if not current_user.is_admin:
+        query = query.filter(Customer.operator_id == current_user.id)
+    status = request.args.get('status')
+    if status:
+        query = query.filter(Customer.status == status)
+    term = request.args.get('q', '')
+    if term:
+        query = search_customers(query, term, ranked=False)
+    per_page = max(1, min(request.args.get('limit', CUSTOMERS_PER_PAGE, type=int), 200))
+    rows, next_cursor = keyset_page(query, per_page=per_page)
+    results = [{
+        'id': c.id, 'name': c.name, 'set_top_box_number': c.set_top_box_number,
+        'monthly_charge': c.monthly_charge, 'status': c.status,
+        'text': f"{c.name} (STB: {c.set_top_box_number}) - Plan: ₹{c.monthly_charge:.2f}"
+    } for c in rows]
+    return jsonify(results=results, next=next_cursor)
+
+
+@app.route('/customers/autocomplete')
+@login_required
+def customer_autocomplete():
+    """Select2-compatible JSON lookup of active customers for the payment form."""
+    term = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+    query = db.session.query(
+        Customer.id, Customer.name, Customer.set_top_box_number, Customer.monthly_charge
+    ).filter(Customer.status == 'Active')
+    if not current_user.is_admin:
+        query = query.filter(Customer.operator_id == current_user.id)
+    query = search_customers(query, term) if term else query
+    results = [{
+        'id': c.id, 'monthly_charge': c.monthly_charge,
+        'text': f"{c.name} (STB: {c.set_top_box_number}) - Plan: ₹{c.monthly_charge:.2f}"
+    } for c in query.order_by(Customer.name).limit(limit)]
+    return jsonify(results=results)
 
 
 @app.route('/customers/add', methods=['GET', 'POST'])
@@ -268,6 +1886,13 @@ def add_customer():
     return render_template('add_customer.html', is_edit=False, customer=None, today_date=date.today().isoformat())
 
 
+@app.route('/customers/import', methods=['GET', 'POST'])
+@login_required
+def import_customers_view():
+    return bulk_import_view('customers', CUSTOMER_IMPORT_COLUMNS,
+                            lambda rows: import_customers(rows, current_user.id))
+
+
 @app.route('/customers/edit/<int:customer_id>', methods=['GET', 'POST'])
 @login_required
 def edit_customer(customer_id):
@@ -303,22 +1928,21 @@ def delete_customer(customer_id):
 @app.route('/payments/record', methods=['GET', 'POST'])
 @login_required
 def record_payment():
-    customers_query = Customer.query.filter_by(status='Active')
-    if not current_user.is_admin:
-        customers_query = customers_query.filter_by(operator_id=current_user.id)
-    customers = customers_query.order_by(Customer.name).all()
     billing_months, billing_years = get_billing_periods()
     customer_id_prefill = request.args.get('customer_id_prefill', type=int)
+    selected_customer = None
     default_amount = None
     if customer_id_prefill:
-        prefill_customer = Customer.query.get(customer_id_prefill)
+        prefill_customer = db.session.get(Customer, customer_id_prefill)
         if prefill_customer and (current_user.is_admin or prefill_customer.operator_id == current_user.id):
+            selected_customer = prefill_customer
             default_amount = prefill_customer.monthly_charge
     if request.method == 'POST':
-        customer_id = request.form.get('customer_id'); customer = Customer.query.get(customer_id)
+        customer_id = request.form.get('customer_id', type=int)
+        customer = db.session.get(Customer, customer_id) if customer_id else None
         if not customer or (not current_user.is_admin and customer.operator_id != current_user.id):
             flash('Invalid customer selected.', 'danger')
-            return render_template('record_payment.html', customers=customers, 
+            return render_template('record_payment.html', selected_customer=None,
                                   today_date=date.today().isoformat(), billing_months=billing_months,
                                   billing_years=billing_years, current_month=datetime.now().month,
                                   current_year=datetime.now().year, customer_id_prefill=None,
@@ -330,37 +1954,85 @@ def record_payment():
             billing_period_year=int(request.form['billing_period_year']), payment_method=request.form['payment_method'],
             transaction_reference=request.form.get('transaction_reference'), received_by=current_user.username 
         )
-        db.session.add(new_payment); db.session.commit()
+        db.session.add(new_payment)
+        allocate_payments([(customer.id, new_payment.billing_period_month, new_payment.billing_period_year, amount_paid)])
+        db.session.commit()
         flash(f'Payment for {customer.name} recorded successfully!', 'success')
         return redirect(url_for('index'))
-    return render_template('record_payment.html', customers=customers, today_date=date.today().isoformat(),
+    return render_template('record_payment.html', selected_customer=selected_customer, today_date=date.today().isoformat(),
                            billing_months=billing_months, billing_years=billing_years, current_month=datetime.now().month,
                            current_year=datetime.now().year, customer_id_prefill=customer_id_prefill,
                            default_amount=default_amount, form_values=None)
 
+@app.route('/payments/import', methods=['GET', 'POST'])
+@login_required
+def import_payments_view():
+    return bulk_import_view('payments', PAYMENT_IMPORT_COLUMNS,
+                            lambda rows: import_payments(rows, current_user))
+
 @app.route('/payments/log')
 @login_required
+@read_replica
 def payments_log():
-    page = request.args.get('page', 1, type=int)
     search_customer_name = request.args.get('customer_name', '')
-    query = Payment.query.join(Customer).order_by(Payment.payment_date.desc(), Payment.id.desc())
+    history = request.args.get('history') == '1'
+    model = PaymentArchive if history else Payment
+    query = model.query.join(Customer).options(
+        contains_eager(model.customer).load_only(Customer.name, Customer.set_top_box_number),
+        joinedload(model.user).load_only(User.username)
+    )
     if not current_user.is_admin:
         query = query.filter(Customer.operator_id == current_user.id)
     if search_customer_name:
         search_pattern = f"%{search_customer_name}%"
         query = query.filter(Customer.name.ilike(search_pattern))
-    payments = query.paginate(page=page, per_page=15)
-    return render_template('payments_log.html', payments=payments, search_customer_name=search_customer_name)
+    total, total_exact = estimated_count(query)
+    payments, next_cursor = payment_log_page(query, model)
+    return render_template('payments_log.html', payments=payments, next_cursor=next_cursor, history=history,
+                           total=total, total_exact=total_exact, search_customer_name=search_customer_name)
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: needs the METRICS_TOKEN bearer token, or an admin login if none is set."""
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    elif not (current_user.is_authenticated and current_user.is_admin):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(prometheus_metrics(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/reports')
 @login_required
+@conditional_view
 def reports_page():
     return render_template('reports.html', report_type=None)
 
+@app.route('/billing', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def billing():
+    billing_months, billing_years = get_billing_periods()
+    if request.method == 'POST':
+        month = request.form.get('month', type=int)
+        year = request.form.get('year', type=int)
+        if not month or not year or not 1 <= month <= 12:
+            flash('Please select a valid billing period.', 'danger')
+        else:
+            created = run_billing(month, year)
+            flash(f'Billing run for {month_name[month]} {year} created {created} invoice(s).', 'success')
+        return redirect(url_for('billing'))
+    return render_template('billing.html', summary=billing_summary(), billing_months=billing_months,
+                           billing_years=billing_years, current_month=datetime.now().month,
+                           current_year=datetime.now().year, month_name=month_name)
+
 @app.route('/reports/outstanding')
 @login_required
 @admin_required 
+@read_replica
+@conditional_view
 def outstanding_payments_report():
     billing_months, billing_years = get_billing_periods()
     report_month = request.args.get('month', type=int)
@@ -369,13 +2041,7 @@ def outstanding_payments_report():
     selected_month_name = ''
     if report_month and report_year:
         selected_month_name = month_name[report_month]
-        paid_customer_ids = [p.customer_id for p in Payment.query.filter_by(
-            billing_period_month=report_month, billing_period_year=report_year
-        ).all()]
-        outstanding_customers = Customer.query.filter(
-            Customer.status == 'Active',
-            Customer.id.notin_(paid_customer_ids)
-        ).order_by(Customer.name).all()
+        outstanding_customers = LazyRows(outstanding_customers_query(report_month, report_year))
     return render_template('reports.html', report_type='outstanding', 
                            outstanding_customers=outstanding_customers,
                            billing_months=billing_months, billing_years=billing_years,
@@ -386,34 +2052,283 @@ def outstanding_payments_report():
 @app.route('/reports/collections')
 @login_required
 @admin_required 
+@read_replica
+@conditional_view
 def collections_report():
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
+    history = request.args.get('history') == '1'
     _form_submitted_and_valid = False
-    collections, total_cash, total_online, grand_total = [], 0, 0, 0
+    collections, method_totals, operator_totals, grand_total = [], {}, {}, 0.0
     if start_date_str and end_date_str:
         _form_submitted_and_valid = True
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-        collections = Payment.query.filter(
-            Payment.payment_date.between(start_date, end_date)
-        ).order_by(Payment.payment_date.desc()).all()
-        total_cash = db.session.query(db.func.sum(Payment.amount_paid)).filter(
-            Payment.payment_date.between(start_date, end_date),
-            Payment.payment_method == 'Cash'
-        ).scalar() or 0.0
-        total_online = db.session.query(db.func.sum(Payment.amount_paid)).filter(
-            Payment.payment_date.between(start_date, end_date),
-            Payment.payment_method == 'Online'
-        ).scalar() or 0.0
-        grand_total = total_cash + total_online
+        for model in payment_models(history):
+            collections += model.query.options(
+                joinedload(model.customer, innerjoin=True).load_only(Customer.name)
+            ).filter(
+                model.payment_date.between(start_date, end_date)
+            ).order_by(model.payment_date.desc(), model.id.desc()).all()
+        if history:
+            collections.sort(key=lambda payment: (payment.payment_date, payment.id), reverse=True)
+        for row in collections_summary(start_date, end_date, history):
+            method_totals[row.payment_method] = method_totals.get(row.payment_method, 0.0) + row.total_amount
+            operator = operator_totals.setdefault(row.username or 'N/A', {'methods': {}, 'total': 0.0, 'count': 0})
+            operator['methods'][row.payment_method] = row.total_amount
+            operator['total'] += row.total_amount
+            operator['count'] += row.payment_count
+        grand_total = sum(method_totals.values())
     return render_template('reports.html', report_type='collections',
                            collections=collections,
-                           total_cash=total_cash, total_online=total_online, grand_total=grand_total,
-                           start_date=start_date_str, end_date=end_date_str,
+                           total_cash=method_totals.get('Cash', 0.0), total_online=method_totals.get('Online', 0.0),
+                           method_totals=method_totals, operator_totals=operator_totals, grand_total=grand_total,
+                           start_date=start_date_str, end_date=end_date_str, history=history,
                            today_date=date.today().isoformat(),
                            _form_submitted_and_valid=_form_submitted_and_valid)
 
+# --- Report Exports ---
+# Exports stream rows from a server-side cursor, so memory stays flat however
+# large the date range is. Totals are accumulated while the rows go out.
+EXPORT_BATCH_SIZE = 1000
+COLLECTIONS_EXPORT_HEADER = ('Date', 'Customer', 'STB No.', 'Amount', 'Method', 'Billing Period', 'Txn Ref.', 'Received By')
+OUTSTANDING_EXPORT_HEADER = ('Name', 'Phone', 'Address', 'Plan', 'Amount Due', 'STB No.')
+
+def csv_response(filename, header, rows):
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0); buffer.truncate()
+        yield buffer.getvalue()
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
+
+def xlsx_response(filename, header, rows):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        flash('XLSX export requires the openpyxl package. Please use CSV instead.', 'warning')
+        return redirect(url_for('reports_page'))
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    spool = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+    workbook.save(spool)
+    spool.seek(0)
+    return send_file(spool, as_attachment=True, download_name=f'{filename}.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+def export_response(filename, header, rows):
+    if request.args.get('format') == 'xlsx':
+        return xlsx_response(filename, header, rows)
+    return csv_response(filename, header, rows)
+
+def collection_export_rows(start_date, end_date, history=False):
+    totals = {}
+    payments = db.union_all(*[
+        db.select(model.id, model.customer_id, model.payment_date, model.amount_paid, model.payment_method,
+                  model.billing_period_month, model.billing_period_year, model.transaction_reference,
+                  model.received_by).where(model.payment_date.between(start_date, end_date))
+        for model in payment_models(history)
+    ]).subquery()
+    query = db.session.query(
+        payments.c.payment_date, Customer.name, Customer.set_top_box_number, payments.c.amount_paid,
+        payments.c.payment_method, payments.c.billing_period_month, payments.c.billing_period_year,
+        payments.c.transaction_reference, payments.c.received_by
+    ).join(Customer, payments.c.customer_id == Customer.id).order_by(
+        payments.c.payment_date.desc(), payments.c.id.desc()
+    ).yield_per(EXPORT_BATCH_SIZE)
+    for p in query:
+        totals[p.payment_method] = totals.get(p.payment_method, 0.0) + p.amount_paid
+        yield (p.payment_date.isoformat(), p.name, p.set_top_box_number, p.amount_paid, p.payment_method,
+               f"{month_name[p.billing_period_month]} {p.billing_period_year}",
+               p.transaction_reference or '', p.received_by or '')
+    yield ()
+    for method, total in sorted(totals.items()):
+        yield ('', f'Total {method}', '', round(total, 2))
+    yield ('', 'Grand Total', '', round(sum(totals.values()), 2))
+
+def outstanding_export_rows(month, year):
+    count, total_due = 0, 0.0
+    query = outstanding_customers_query(month, year).yield_per(EXPORT_BATCH_SIZE)
+    for c in query:
+        count += 1
+        total_due += c.amount_due
+        yield (c.name, c.phone_number or '', c.address, c.plan_details or '', round(c.amount_due, 2), c.set_top_box_number)
+    yield ()
+    yield (f'{count} customers', '', '', 'Total Due', round(total_due, 2))
+
+@app.route('/reports/collections/export')
+@login_required
+@admin_required
+@read_replica
+def export_collections_report():
+    try:
+        start_date = datetime.strptime(request.args.get('start_date', ''), '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args.get('end_date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        flash('Please select a valid date range to export.', 'danger')
+        return redirect(url_for('collections_report'))
+    return export_response(f'collections_{start_date}_{end_date}', COLLECTIONS_EXPORT_HEADER,
+                           collection_export_rows(start_date, end_date, history=request.args.get('history') == '1'))
+
+@app.route('/reports/outstanding/export')
+@login_required
+@admin_required
+@read_replica
+def export_outstanding_report():
+    report_month = request.args.get('month', type=int)
+    report_year = request.args.get('year', type=int)
+    if not report_month or not report_year or not 1 <= report_month <= 12:
+        flash('Please select a month and year to export.', 'danger')
+        return redirect(url_for('outstanding_payments_report'))
+    return export_response(f'outstanding_{report_year}_{report_month:02d}', OUTSTANDING_EXPORT_HEADER,
+                           outstanding_export_rows(report_month, report_year))
+
+
+# --- Background Report Jobs ---
+# Heavy reports can be queued instead of computed in the request. Jobs live in
+# the report_job table and are run by a thread pool in the web process
+# (REPORT_JOB_THREADS) or by `flask worker`. A finished job is reused for
+# identical parameters for REPORT_JOB_CACHE_TTL seconds. Results are stored in
+# the table, so a job fails once its CSV passes REPORT_JOB_MAX_BYTES; the
+# streaming export links have no such limit.
+REPORT_JOB_TIMEOUT = timedelta(minutes=30)
+REPORT_JOB_RETENTION = timedelta(days=7)
+_report_executor = []
+
+def _collections_job(params):
+    start_date, end_date = _parse_date(params['start_date']), _parse_date(params['end_date'])
+    return (f'collections_{start_date}_{end_date}', COLLECTIONS_EXPORT_HEADER,
+            collection_export_rows(start_date, end_date, history=params.get('history') == '1'))
+
+def _outstanding_job(params):
+    month, year = int(params['month']), int(params['year'])
+    if not 1 <= month <= 12:
+        raise ValueError('month must be between 1 and 12')
+    return f'outstanding_{year}_{month:02d}', OUTSTANDING_EXPORT_HEADER, outstanding_export_rows(month, year)
+
+REPORT_JOB_KINDS = {
+    'collections': (_collections_job, ('start_date', 'end_date', 'history')),
+    'outstanding': (_outstanding_job, ('month', 'year')),
+}
+
+def enqueue_report_job(kind, params, user_id):
+    """Return a fresh finished or pending job for these parameters, or queue a new one."""
+    params_key = f'{kind}:{json.dumps(params, sort_keys=True)}'
+    fresh_after = datetime.now() - timedelta(seconds=app.config['REPORT_JOB_CACHE_TTL'])
+    existing = ReportJob.query.filter(
+        ReportJob.params_key == params_key,
+        or_(ReportJob.status.in_(('queued', 'running')),
+            and_(ReportJob.status == 'done', ReportJob.finished_at >= fresh_after))
+    ).order_by(ReportJob.id.desc()).first()
+    if existing:
+        return existing
+    job = ReportJob(kind=kind, params=json.dumps(params), params_key=params_key, created_by=user_id)
+    db.session.add(job)
+    db.session.commit()
+    if app.config['REPORT_JOB_THREADS']:
+        if not _report_executor:
+            _report_executor.append(ThreadPoolExecutor(max_workers=app.config['REPORT_JOB_THREADS']))
+        _report_executor[0].submit(run_report_job, job.id)
+    return job
+
+def claim_report_job(job_id):
+    """Atomically mark a queued (or timed-out running) job as running; False if someone else has it."""
+    claimable = or_(ReportJob.status == 'queued',
+                    and_(ReportJob.status == 'running', ReportJob.started_at < datetime.now() - REPORT_JOB_TIMEOUT))
+    claimed = db.session.execute(db.update(ReportJob).where(ReportJob.id == job_id, claimable).values(
+        status='running', started_at=datetime.now()
+    )).rowcount == 1
+    db.session.commit()
+    return claimed
+
+def run_report_job(job_id):
+    with app.app_context():
+        if not claim_report_job(job_id):
+            return
+        job = db.session.get(ReportJob, job_id)
+        try:
+            run, _ = REPORT_JOB_KINDS[job.kind]
+            _, header, rows = run(json.loads(job.params))
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(header)
+            limit = app.config['REPORT_JOB_MAX_BYTES']
+            for row in rows:
+                writer.writerow(row)
+                if buffer.tell() > limit:
+                    job.error, job.status = (f'Report is larger than {limit:,} bytes; narrow the range '
+                                             'or use the Export CSV link, which streams.'), 'failed'
+                    break
+            else:
+                job.result, job.status = buffer.getvalue(), 'done'
+        except Exception as exc:
+            db.session.rollback()
+            app.logger.exception("Report job %s failed", job_id)
+            job.error, job.status = str(exc), 'failed'
+        job.finished_at = datetime.now()
+        db.session.commit()
+
+def report_job_json(job):
+    return {
+        'id': job.id, 'kind': job.kind, 'params': json.loads(job.params), 'status': job.status, 'error': job.error,
+        'status_url': url_for('report_job_status', job_id=job.id),
+        'download_url': url_for('download_report_job', job_id=job.id) if job.status == 'done' else None,
+    }
+
+def wants_json():
+    return request.is_json or request.args.get('format') == 'json' or \
+        request.accept_mimetypes.best == 'application/json'
+
+@app.route('/reports/jobs', methods=['POST'])
+@login_required
+@admin_required
+def create_report_job():
+    data = request.get_json(silent=True) or request.form
+    kind = data.get('kind')
+    if kind not in REPORT_JOB_KINDS:
+        return jsonify(error='Unknown report kind.'), 400
+    run, fields = REPORT_JOB_KINDS[kind]
+    params = {field: str(data.get(field, '')) for field in fields}
+    try:
+        run(params)  # validates the parameters; the rows generator is not started
+    except (KeyError, ValueError) as exc:
+        if wants_json():
+            return jsonify(error=f'Invalid report parameters: {exc}'), 400
+        flash('Please select valid report parameters.', 'danger')
+        return redirect(url_for('reports_page'))
+    job = enqueue_report_job(kind, params, current_user.id)
+    if wants_json():
+        return jsonify(report_job_json(job)), 202
+    return redirect(url_for('report_job_status', job_id=job.id))
+
+@app.route('/reports/jobs/<int:job_id>')
+@login_required
+@admin_required
+def report_job_status(job_id):
+    job = ReportJob.query.options(db.defer(ReportJob.result)).filter_by(id=job_id).first_or_404()
+    if wants_json():
+        return jsonify(report_job_json(job))
+    return render_template('report_job.html', job=job, params=json.loads(job.params))
+
+@app.route('/reports/jobs/<int:job_id>/download')
+@login_required
+@admin_required
+def download_report_job(job_id):
+    job = ReportJob.query.filter_by(id=job_id, status='done').first_or_404()
+    run, _ = REPORT_JOB_KINDS[job.kind]
+    filename, _, _ = run(json.loads(job.params))
+    return Response(job.result, mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
+
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
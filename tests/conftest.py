@@ -0,0 +1,90 @@
+import os
+import tempfile
+from datetime import date
+
+import pytest
+
+# app.py reads its configuration at import time, so point it at a scratch
+# SQLite file (and run report jobs inline) before importing it.
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix='cablepro-tests-'), 'test.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ['REPORT_JOB_THREADS'] = '0'
+os.environ.pop('DATABASE_REPLICA_URL', None)
+os.environ.pop('USER_CACHE_REDIS_URL', None)
+
+import app as cablepro  # noqa: E402
+
+db = cablepro.db
+# PostgreSQL enforces foreign keys; make the test database do the same.
+cablepro.SQLITE_PRAGMAS['foreign_keys'] = 'ON'
+
+
+def _remove_database():
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
+
+
+@pytest.fixture(autouse=True)
+def app_context():
+    """A fresh database and empty in-process caches for every test."""
+    cablepro.app.config['TESTING'] = True
+    with cablepro.app.app_context():
+        db.engine.dispose()
+        _remove_database()
+        db.create_all()
+        cablepro.install_search_index()
+        cablepro.invalidate_dashboard_cache()
+        cablepro.invalidate_fragment_cache()
+        yield
+        user_ids = [user_id for user_id, in db.session.query(cablepro.User.id)]
+        db.session.remove()
+        for user_id in user_ids:
+            cablepro.invalidate_cached_user(user_id)
+        db.engine.dispose()
+
+
+def make_user(username, is_admin=False):
+    user = cablepro.User(username=username, is_admin=is_admin)
+    user.set_password(username)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def admin():
+    return make_user('admin', is_admin=True)
+
+
+@pytest.fixture
+def operator():
+    return make_user('operator')
+
+
+def make_customer(operator, stb, monthly_charge=200.0, status='Active'):
+    customer = cablepro.Customer(operator_id=operator.id, name=f'Customer {stb}', address=f'{stb} Street',
+                                 monthly_charge=monthly_charge, set_top_box_number=stb, status=status)
+    db.session.add(customer)
+    db.session.commit()
+    return customer
+
+
+def record_payment(customer, amount, paid_on, month=None, year=None, method='Cash', user=None):
+    payment = cablepro.Payment(customer_id=customer.id, user_id=user.id if user else None, payment_date=paid_on,
+                               amount_paid=amount, billing_period_month=month or paid_on.month,
+                               billing_period_year=year or paid_on.year, payment_method=method)
+    db.session.add(payment)
+    db.session.commit()
+    return payment
+
+
+def collections_totals(start_date, end_date, history=False):
+    """{(method, operator_id): (total, count)} from the rollup-backed summary."""
+    return {(row.payment_method, row.operator_id): (round(row.total_amount, 2), row.payment_count)
+            for row in cablepro.collections_summary(start_date, end_date, history)}
+
+
+def month_before(day, months=1):
+    total = day.year * 12 + day.month - 1 - months
+    return date(total // 12, total % 12 + 1, 1)
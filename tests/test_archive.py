@@ -0,0 +1,74 @@
+from datetime import date
+
+import app as cablepro
+from conftest import collections_totals, db, make_customer, make_user, month_before, record_payment
+
+OLD = date(2024, 3, 10)
+
+
+def archive_old_payments():
+    return cablepro.archive_payments(cablepro.archive_cutoff(1))
+
+
+def test_archiving_moves_rows_and_keeps_their_ids(admin):
+    customer = make_customer(admin, 'STB1')
+    old = record_payment(customer, 100, OLD)
+    recent = record_payment(customer, 50, date.today())
+    old_id = old.id
+
+    assert archive_old_payments() == 1
+
+    assert [payment.id for payment in cablepro.Payment.query] == [recent.id]
+    assert [payment.id for payment in cablepro.PaymentArchive.query] == [old_id]
+
+
+def test_archived_ids_are_not_handed_out_again(admin):
+    customer = make_customer(admin, 'STB1')
+    record_payment(customer, 100, date(2024, 3, 10))
+    newest = record_payment(customer, 100, date(2024, 3, 11))
+    newest_id = newest.id
+    archive_old_payments()
+
+    assert record_payment(customer, 100, date.today()).id > newest_id
+
+
+def test_collections_totals_follow_the_history_switch(admin, operator):
+    customer = make_customer(operator, 'STB1')
+    record_payment(customer, 100, OLD)
+    record_payment(customer, 30, OLD, method='Online')
+    record_payment(customer, 7, date(2024, 3, 20), month=month_before(date.today()).month,
+                   year=month_before(date.today()).year)
+    whole_month = (date(2024, 3, 1), date(2024, 3, 31))
+    before = collections_totals(*whole_month)
+    archive_old_payments()
+
+    assert collections_totals(*whole_month, history=True) == before
+    assert collections_totals(*whole_month) == {('Cash', operator.id): (7.0, 1)}
+    exported = list(cablepro.collection_export_rows(*whole_month))
+    assert exported[-1] == ('', 'Grand Total', '', 7.0)
+
+
+def test_outstanding_report_reads_archived_payments(admin):
+    paid = make_customer(admin, 'STB1')
+    unpaid = make_customer(admin, 'STB2')
+    record_payment(paid, 200, OLD)
+    archive_old_payments()
+
+    owing = [row.id for row in cablepro.outstanding_customers_query(OLD.month, OLD.year)]
+    assert owing == [unpaid.id]
+    assert cablepro.run_billing(OLD.month, OLD.year) == 2
+    assert cablepro.Invoice.query.filter_by(customer_id=paid.id).one().status == 'paid'
+
+
+def test_users_who_recorded_archived_payments_can_be_deleted(admin):
+    clerk = make_user('clerk')
+    record_payment(make_customer(admin, 'STB1'), 100, OLD, user=clerk)
+    archive_old_payments()
+    clerk_id = clerk.id
+
+    response = cablepro.logged_in_client(admin).post(f'/users/delete/{clerk_id}')
+
+    assert response.status_code == 302
+    db.session.expire_all()
+    assert db.session.get(cablepro.User, clerk_id) is None
+    assert cablepro.PaymentArchive.query.one().user_id is None
@@ -0,0 +1,92 @@
+from datetime import date
+
+import app as cablepro
+from conftest import db, make_customer, record_payment
+
+MONTH, YEAR = 3, 2024
+
+
+def invoice_for(customer):
+    db.session.expire_all()
+    return cablepro.Invoice.query.filter_by(customer_id=customer.id, billing_period_month=MONTH,
+                                            billing_period_year=YEAR).one_or_none()
+
+
+def post_payment(user, customer, amount, month=MONTH, year=YEAR):
+    client = cablepro.logged_in_client(user)
+    response = client.post('/payments/record', data={
+        'customer_id': customer.id, 'amount_paid': amount, 'payment_date': f'{year}-{month:02d}-20',
+        'billing_period_month': month, 'billing_period_year': year, 'payment_method': 'Cash',
+    })
+    assert response.status_code == 302
+
+
+def test_billing_run_counts_payments_already_made(admin):
+    paid = make_customer(admin, 'STB1', monthly_charge=100)
+    partial = make_customer(admin, 'STB2', monthly_charge=100)
+    unpaid = make_customer(admin, 'STB3', monthly_charge=100)
+    inactive = make_customer(admin, 'STB4', monthly_charge=100, status='Inactive')
+    record_payment(paid, 60, date(YEAR, MONTH, 2))
+    record_payment(paid, 40, date(YEAR, MONTH, 9))
+    record_payment(partial, 30, date(YEAR, MONTH, 2))
+    record_payment(unpaid, 100, date(YEAR, MONTH + 1, 2))  # a different period
+
+    assert cablepro.run_billing(MONTH, YEAR) == 3
+
+    assert (invoice_for(paid).amount_paid, invoice_for(paid).status) == (100, 'paid')
+    assert (invoice_for(partial).amount_paid, invoice_for(partial).status) == (30, 'partial')
+    assert (invoice_for(unpaid).amount_paid, invoice_for(unpaid).status) == (0, 'open')
+    assert invoice_for(inactive) is None
+
+
+def test_billing_run_is_idempotent(admin):
+    customer = make_customer(admin, 'STB1', monthly_charge=100)
+    record_payment(customer, 30, date(YEAR, MONTH, 2))
+    cablepro.run_billing(MONTH, YEAR)
+
+    assert cablepro.run_billing(MONTH, YEAR) == 0
+    assert cablepro.Invoice.query.count() == 1
+    assert invoice_for(customer).amount_paid == 30
+
+
+def test_later_payments_are_allocated_once_to_their_own_period(admin):
+    customer = make_customer(admin, 'STB1', monthly_charge=100)
+    record_payment(customer, 30, date(YEAR, MONTH, 2))
+    cablepro.run_billing(MONTH, YEAR)
+
+    post_payment(admin, customer, 50)
+    assert (invoice_for(customer).amount_paid, invoice_for(customer).status) == (80, 'partial')
+    post_payment(admin, customer, 70, month=MONTH + 1)
+    assert invoice_for(customer).amount_paid == 80
+    post_payment(admin, customer, 40)
+    assert (invoice_for(customer).amount_paid, invoice_for(customer).status) == (120, 'paid')
+    assert invoice_for(customer).balance == -20
+
+
+def test_imported_payments_are_allocated_to_invoices(admin):
+    first = make_customer(admin, 'STB1', monthly_charge=100)
+    second = make_customer(admin, 'STB2', monthly_charge=100)
+    cablepro.run_billing(MONTH, YEAR)
+
+    report = cablepro.import_payments([
+        {'set_top_box_number': 'STB1', 'payment_date': '2024-03-05', 'amount_paid': '25'},
+        {'set_top_box_number': 'STB1', 'payment_date': '2024-03-06', 'amount_paid': '25'},
+        {'set_top_box_number': 'STB2', 'payment_date': '2024-03-07'},
+    ], admin)
+
+    assert report['inserted'] == 3
+    assert (invoice_for(first).amount_paid, invoice_for(first).status) == (50, 'partial')
+    assert (invoice_for(second).amount_paid, invoice_for(second).status) == (100, 'paid')
+
+
+def test_outstanding_report_shows_invoice_balances(admin):
+    partial = make_customer(admin, 'STB1', monthly_charge=100)
+    settled = make_customer(admin, 'STB2', monthly_charge=100)
+    record_payment(partial, 40, date(YEAR, MONTH, 2))
+    record_payment(settled, 100, date(YEAR, MONTH, 2))
+
+    before = {row.id: row.amount_due for row in cablepro.outstanding_customers_query(MONTH, YEAR)}
+    assert before == {}  # before billing, any payment for the period counts as paid
+    cablepro.run_billing(MONTH, YEAR)
+    after = {row.id: row.amount_due for row in cablepro.outstanding_customers_query(MONTH, YEAR)}
+    assert after == {partial.id: 60}
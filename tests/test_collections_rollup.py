@@ -0,0 +1,62 @@
+from datetime import date
+
+import app as cablepro
+from conftest import collections_totals, db, make_customer, record_payment
+
+
+def rollup_rows():
+    return sorted((row.period, row.period_start, row.payment_method, row.operator_id,
+                   round(row.total_amount, 2), row.payment_count)
+                  for row in cablepro.CollectionRollup.query.all())
+
+
+def test_incremental_rollup_matches_a_rebuild(admin, operator):
+    first = make_customer(admin, 'STB1')
+    second = make_customer(operator, 'STB2')
+    record_payment(first, 100, date(2024, 1, 31))
+    record_payment(first, 50.5, date(2024, 2, 1), method='Online')
+    record_payment(second, 75, date(2024, 2, 1))
+    doomed = record_payment(second, 20, date(2024, 2, 14))
+    db.session.delete(doomed)
+    db.session.commit()
+    incremental = [row for row in rollup_rows() if row[5]]
+
+    cablepro.rebuild_collection_rollup()
+
+    assert rollup_rows() == incremental
+
+
+def test_summary_combines_whole_months_with_partial_days(admin):
+    customer = make_customer(admin, 'STB1')
+    for day, amount in ((date(2024, 1, 15), 10), (date(2024, 1, 31), 20), (date(2024, 2, 10), 40),
+                        (date(2024, 3, 1), 80), (date(2024, 3, 2), 160)):
+        record_payment(customer, amount, day)
+
+    assert collections_totals(date(2024, 1, 31), date(2024, 3, 1)) == {('Cash', admin.id): (140.0, 3)}
+    assert collections_totals(date(2024, 1, 1), date(2024, 3, 31)) == {('Cash', admin.id): (310.0, 5)}
+    assert collections_totals(date(2024, 2, 10), date(2024, 2, 10)) == {('Cash', admin.id): (40.0, 1)}
+
+
+def test_deleting_a_customer_removes_their_collections(admin):
+    kept = make_customer(admin, 'STB1')
+    dropped = make_customer(admin, 'STB2')
+    record_payment(kept, 100, date(2024, 1, 5))
+    record_payment(dropped, 300, date(2024, 1, 6))
+
+    db.session.delete(dropped)
+    db.session.commit()
+
+    assert collections_totals(date(2024, 1, 1), date(2024, 1, 31)) == {('Cash', admin.id): (100.0, 1)}
+
+
+def test_imported_payments_are_counted_once(admin, operator):
+    customer = make_customer(operator, 'STB1')
+    report = cablepro.import_payments([
+        {'set_top_box_number': 'STB1', 'payment_date': '2024-05-02', 'amount_paid': '120'},
+        {'customer_id': customer.id, 'payment_date': '2024-05-03', 'payment_method': 'Online'},
+    ], admin)
+
+    assert report == {'inserted': 2, 'errors': []}
+    assert collections_totals(date(2024, 5, 1), date(2024, 5, 31)) == {
+        ('Cash', operator.id): (120.0, 1), ('Online', operator.id): (200.0, 1),
+    }
@@ -0,0 +1,69 @@
+import pytest
+
+import app as cablepro
+from conftest import db, make_customer
+
+
+def customer_row(stb, **fields):
+    return {'name': f'Customer {stb}', 'address': f'{stb} Street', 'monthly_charge': '250',
+            'set_top_box_number': stb, **fields}
+
+
+def test_valid_customers_are_inserted(operator):
+    report = cablepro.import_customers([customer_row('STB1'), customer_row('STB2', status='Suspended')], operator.id)
+
+    assert report == {'inserted': 2, 'errors': []}
+    assert {c.set_top_box_number: c.status for c in cablepro.Customer.query} == {'STB1': 'Active', 'STB2': 'Suspended'}
+
+
+def test_rows_that_are_not_objects_are_rejected(operator):
+    report = cablepro.import_customers([['STB1'], 'STB2', None, customer_row('STB3')], operator.id)
+
+    assert report['inserted'] == 1
+    assert [error['row'] for error in report['errors']] == [1, 2, 3]
+    assert all('object of named fields' in error['error'] for error in report['errors'])
+
+
+@pytest.mark.parametrize('charge', ['nan', 'inf', '-Infinity', '-5', 'ten'])
+def test_non_finite_and_negative_amounts_are_rejected(operator, charge):
+    report = cablepro.import_customers([customer_row('STB1', monthly_charge=charge)], operator.id)
+
+    assert report['inserted'] == 0
+    assert report['errors'] == [{'row': 1, 'error': f"'monthly_charge' must be a non-negative number, got {charge!r}"}]
+
+
+def test_payment_amounts_are_validated(admin):
+    make_customer(admin, 'STB1')
+    report = cablepro.import_payments([
+        {'set_top_box_number': 'STB1', 'payment_date': '2024-03-01', 'amount_paid': 'NaN'},
+        {'set_top_box_number': 'STB1', 'payment_date': '2024-03-01', 'amount_paid': '-1'},
+        {'set_top_box_number': 'STB1', 'payment_date': '2024-03-01', 'amount_paid': '10'},
+    ], admin)
+
+    assert report['inserted'] == 1
+    assert [error['row'] for error in report['errors']] == [1, 2]
+
+
+def test_duplicate_set_top_boxes_are_reported_per_row(operator):
+    make_customer(operator, 'STB1')
+    report = cablepro.import_customers([customer_row('STB1'), customer_row('STB2'), customer_row('STB2')], operator.id)
+
+    assert report['inserted'] == 1
+    assert [error['row'] for error in report['errors']] == [1, 3]
+
+
+def test_database_rejections_only_blame_the_failing_row(operator):
+    db.session.execute(db.text(
+        "CREATE TRIGGER reject_bad_customer BEFORE INSERT ON customer WHEN NEW.name = 'Bad' "
+        "BEGIN SELECT RAISE(ABORT, 'rejected by test trigger'); END"
+    ))
+    db.session.commit()
+
+    report = cablepro.import_customers([customer_row('STB1'), customer_row('STB2', name='Bad'), customer_row('STB3')],
+                                       operator.id)
+
+    assert report['inserted'] == 2
+    assert len(report['errors']) == 1
+    assert report['errors'][0]['row'] == 2
+    assert 'rejected by test trigger' in report['errors'][0]['error']
+    assert sorted(c.set_top_box_number for c in cablepro.Customer.query) == ['STB1', 'STB3']
@@ -0,0 +1,43 @@
+from datetime import date
+
+import pytest
+
+import app as cablepro
+from conftest import make_customer, make_user, record_payment
+
+
+@pytest.fixture
+def seeded_admin(admin, operator):
+    today = date.today()
+    for n in range(30):
+        customer = make_customer(operator if n % 2 else admin, f'STB{n:04d}', monthly_charge=200 + n,
+                                 status='Active' if n % 5 else 'Inactive')
+        if n % 3:
+            record_payment(customer, 100, today, method='Cash' if n % 4 else 'Online', user=admin)
+    return admin
+
+
+@pytest.mark.parametrize('url,budget', sorted(cablepro.main_page_budgets().items()))
+def test_main_page_stays_within_query_budget(seeded_admin, url, budget):
+    client = cablepro.logged_in_client(seeded_admin)
+    with cablepro.query_budget(budget, label=url):
+        response = cablepro.fetch_uncached(client, url)
+    assert response.status_code == 200
+
+
+def test_operator_pages_stay_within_query_budget(operator):
+    for n in range(10):
+        record_payment(make_customer(operator, f'OP{n:03d}'), 200, date.today(), user=operator)
+    client = cablepro.logged_in_client(operator)
+    for url in ('/index', '/customers', '/payments/log'):
+        with cablepro.query_budget(cablepro.main_page_budgets()[url], label=url):
+            response = cablepro.fetch_uncached(client, url)
+        assert response.status_code == 200
+
+
+def test_query_budget_reports_the_statements():
+    make_user('someone')
+    with pytest.raises(AssertionError, match='issued 2 queries'):
+        with cablepro.query_budget(1, label='two lookups'):
+            cablepro.User.query.all()
+            cablepro.Customer.query.all()